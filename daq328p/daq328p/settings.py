@@ -117,6 +117,15 @@ ROOT_URLCONF = 'daq328p.urls'
 # Python dotted path to the WSGI application used by Django's runserver.
 WSGI_APPLICATION = 'daq328p.wsgi.application'
 
+# Hardware bridge the views query. BRIDGE_TRANSPORT is redis, or local,
+# unix, unix:PATH or auto to skip redis when the bridge runs on this host
+# (see hardware/transport.py). BRIDGE_TRACE_SAMPLE is the fraction of
+# queries traced for the traces view (see hardware/tracing.py).
+BRIDGE_CHANNEL      = 'test'
+BRIDGE_HOST         = '192.168.1.127'
+BRIDGE_TRANSPORT    = 'redis'
+BRIDGE_TRACE_SAMPLE = 0.0
+
 print here() + '/templates'
 
 TEMPLATE_DIRS = (
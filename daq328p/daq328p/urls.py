@@ -11,7 +11,10 @@ urlpatterns = patterns('',
     url(r'^query/(?P<cmd>.*)$', 'daq328p.views.query', name='query'),
     url(r'^query', 'daq328p.views.query', name='query'),
     
+    url(r'^history/(?P<sn>[^/]+)$', 'daq328p.views.history', name='history'),
+
     url(r'^cmd', 'daq328p.views.cmd', name='cmd'),
+    url(r'^traces$', 'daq328p.views.traces', name='traces'),
     
     # url(r'^daq328p/', include('daq328p.foo.urls')),
 
@@ -1,7 +1,9 @@
+import time
 import simplejson
 import datetime
 
-from django.http import HttpResponse
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseBadRequest
 from django.core import serializers
 from django.template import RequestContext
 from django.shortcuts import render_to_response
@@ -11,11 +13,31 @@ import daq328p.hardware.redisbridge as RB
 
 logger = getLogger("app")
 
+INFO_TTL   = 60
+MAX_TRACES = 100
+_info      = {'at': 0, 'res': None}
+
+def bridge():
+    Daq = RB.shared_client(channel=settings.BRIDGE_CHANNEL, host=settings.BRIDGE_HOST,
+                           kind=settings.BRIDGE_TRANSPORT)
+    Daq.trace_sample = settings.BRIDGE_TRACE_SAMPLE
+    return Daq
+
+def board_info():
+    '''
+    Reply of the board to 'I', asked at most once every INFO_TTL seconds
+    '''
+    if _info['res'] is None or time.time() - _info['at'] > INFO_TTL:
+        res = bridge().query('I')
+        if res[0]:
+            return res
+        _info['at'], _info['res'] = time.time(), res
+    return _info['res']
+
 def home(request):
     time_stamp = (datetime.datetime.now())    
-    Daq = RB.Client(channel='test',host='192.168.1.127')
-    #res = Daq.query('I')
-    msg = str(time_stamp) + '\n' + res[1]
+    res = board_info()
+    msg = str(time_stamp) + '\n' + str(res[1])
     logger.info(msg)
 #    return HttpResponse(msg)
     page_context = {'page_title': 'Daq328p', 'datetime':msg}
@@ -27,17 +49,43 @@ def query(request, **kwargs):
     time_stamp = (datetime.datetime.now())
     #res = Daq.read()
     #res = Daq.query(cmd,expected_text='cmd>')
-    Daq = Client()
+    Daq = bridge()
     res = Daq.query(cmd)
     
     # if errors:
     #     msg = "Loaded at: %s errors in reading H" % time_stamp
     # else:
-    msg = str('query : ') + res
+    msg = str('query : ') + str(res)
 #    logger.info(res[1])    
 #    print simplejson.dumps(str(res[1]))
     return HttpResponse(simplejson.dumps(str(res)),mimetype='text/json')
 
+def history(request, **kwargs):
+    sn = kwargs['sn']
+    cmd = request.GET.get('cmd', 'history')
+    params = dict((k, v) for k, v in request.GET.items() if k in ('seconds', 'n', 'width'))
+    logger.info('history(sn=%s, cmd=%s, params=%s)' % (sn, cmd, str(params)))
+    try:
+        for k in params:
+            params[k] = int(params[k]) if k == 'n' else float(params[k])
+    except ValueError:
+        return HttpResponseBadRequest(simplejson.dumps('bad number in %s' % str(params)), mimetype='text/json')
+    Daq = bridge()
+    res = Daq.query(cmd, sn=sn, **params)
+    return HttpResponse(simplejson.dumps(res), mimetype='text/json')
+
+def traces(request):
+    '''
+    Slowest traced bridge queries of this process, with per stage timing,
+    at most MAX_TRACES
+    '''
+    try:
+        n = min(max(int(request.GET.get('n', 20)), 0), MAX_TRACES)
+    except ValueError:
+        return HttpResponseBadRequest(simplejson.dumps('bad number n=%s' % request.GET.get('n')), mimetype='text/json')
+    Daq = bridge()
+    return HttpResponse(simplejson.dumps(Daq.traces.slowest(n)), mimetype='text/json')
+
 def cmd(request):    
     logger.debug("cmd()")
     cmd = request.GET.get('cmd')
@@ -0,0 +1,275 @@
+"""aio.py -
+
+asyncio driver for the Daq328p firmware.
+
+AsyncDaq328p has the command surface of Daq328p (send, read, query,
+query_many) as coroutines, and runs on an event loop instead of a
+listener thread: the serial port is watched with loop.add_reader() and
+replies resolve asyncio futures. The code base is Python 2, so this uses
+trollius, the Python 2 port of asyncio (yield From(...) instead of await).
+Redis publishing goes through a BatchPublisher, so the loop only ever
+queues messages and never waits on a redis round trip.
+
+    loop = asyncio.get_event_loop()
+    daq = AsyncDaq328p('/dev/ttyUSB0', loop=loop)
+
+    @asyncio.coroutine
+    def main():
+        yield From(daq.start())
+        print (yield From(daq.query('I')))
+        stream = daq.samples()
+        while True:
+            t, rows = yield From(stream.get())
+
+Usage:
+  aio.py [--dev=DEV]
+  aio.py (-h | --help)
+
+Options:
+  -h, --help
+  --dev=DEV              [default: /dev/ttyS0]
+
+"""
+
+import serial
+import trollius as asyncio
+
+from trollius import From, Return
+from logbook import Logger
+from docopt import docopt
+from redis import Redis
+
+from daq328p import Daq328pBase, PendingQuery
+from framing import FrameParser
+from publisher import BatchPublisher
+from history import HISTORY_COMMANDS
+from clock import monotonic, time_ns, format_ns
+
+##########################################################################################
+class SampleStream(object):
+    '''
+    Decoded samples of one AsyncDaq328p, get() returns [t, rows] with t
+    in nanoseconds since the epoch (clock.time_ns()).
+    When the consumer falls behind by maxsize samples the oldest are dropped.
+    Once the port hangs up get() raises the error.
+    '''
+
+    def __init__(self, daq, maxsize=1000):
+        self.daq     = daq
+        self.queue   = asyncio.Queue(maxsize, loop=daq.loop)
+        self.dropped = 0
+        self.error   = None
+
+    def put(self, item):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(item)
+
+    def fail(self, error):
+        self.error = error
+        self.put(None)
+
+    @asyncio.coroutine
+    def get(self):
+        item = yield From(self.queue.get())
+        if item is None:
+            # Keep failing the gets that follow
+            self.queue.put_nowait(None)
+            raise self.error
+        raise Return(item)
+
+    def close(self):
+        if self in self.daq.streams:
+            self.daq.streams.remove(self)
+
+##########################################################################################
+class AsyncDaq328p(Daq328pBase):
+
+    def __init__(self, port, loop=None, baudrate=115200, redis=None, namespace='', publisher=None):
+        self.loop      = loop if loop is not None else asyncio.get_event_loop()
+        self.serial    = serial.Serial(port, baudrate, timeout=0)
+        self.byte_ns   = 10 * 10**9 // baudrate
+        self.redis     = redis if redis is not None else Redis()
+        self.namespace = namespace
+        self.parser    = FrameParser()
+        self.reply     = ''
+        self.pending   = []
+        self.streams   = []
+        self.init_storage()
+        self.own_publisher = publisher is None
+        if self.own_publisher:
+            publisher = BatchPublisher(self.redis, self.publish_batch, self.publish_delay)
+            publisher.start()
+        self.publisher = publisher
+        self.init_metrics()
+        self.Log = Logger('AsyncDaq328p')
+
+    @asyncio.coroutine
+    def start(self, binary=False):
+        '''
+        Start watching the port and identify the board
+        '''
+        self.serial.flushInput()
+        self.loop.add_reader(self.serial.fileno(), self.on_readable)
+        self.start_metrics()
+        out = yield From(self.query('I'))
+        self.Log.info('start() %s' % str(out))
+        if binary:
+            out = yield From(self.query('B1', tag='mode'))
+            self.parser.binary = not out[0] and out[1] == 'bin'
+        raise Return(out)
+
+    def close(self):
+        self.loop.remove_reader(self.serial.fileno())
+        for q in self.pending:
+            if not q.future.done():
+                q.future.set_result((1, ''))
+        self.pending = []
+        self.stop_metrics()
+        self.stop_capture()
+        if self.own_publisher:
+            self.publisher.stop()
+        self.serial.close()
+
+    def on_readable(self):
+        try:
+            n = self.serial.inWaiting()
+            data = self.serial.read(n) if n else ''
+        except Exception as E:
+            self.hangup(E)
+            return
+        if not data:
+            # Readable with nothing to read: the port hung up (unplugged)
+            self.hangup(IOError('%s hung up' % self.serial.port))
+            return
+        t = time_ns()
+        if self.capture is not None:
+            self.capture.write(data, t)
+        self.metrics.incr('bytes_in', len(data))
+        self.add_reply(data)
+        if self.pending:
+            self.resolve(self.match_replies())
+        self.process_chunk(data, t)
+
+    def hangup(self, error):
+        '''
+        Stop watching the port and fail the pending queries and the sample
+        streams with error
+        '''
+        self.Log.error('on_readable(): %s' % error)
+        self.loop.remove_reader(self.serial.fileno())
+        pending, self.pending = self.pending, []
+        for q in pending:
+            if not q.future.done():
+                q.future.set_exception(error)
+        for stream in self.streams:
+            stream.fail(error)
+
+    def store_rows(self, t, rows):
+        Daq328pBase.store_rows(self, t, rows)
+        for stream in self.streams:
+            stream.put([t, rows])
+
+    def samples(self, maxsize=1000):
+        stream = SampleStream(self, maxsize)
+        self.streams.append(stream)
+        return stream
+
+    def expire_pending(self):
+        if self.pending:
+            self.resolve(self.match_replies(expire=True))
+
+    def send(self, data, CR=True):
+        '''
+        Write data to the port, returns the same error codes as Daq328p.send()
+        '''
+        if len(data) == 0:
+            return
+        if CR and data[-1] != '\n':
+            data += '\n'
+        if not self.pending:
+            self.reply = ''
+        try:
+            self.serial.write(data)
+            self.metrics.incr('bytes_out', len(data))
+            serial_error = 0
+        except Exception:
+            serial_error = 1
+        self.publisher.set(self.namespace + 'daq328p-send', data)
+        return serial_error
+
+    def wait_reply(self, opts, cmd=''):
+        q = PendingQuery(opts, asyncio.Future(loop=self.loop), cmd)
+        self.pending.append(q)
+
+        def forget(future):
+            # The reply of a cancelled query must not go to the next one
+            if future.cancelled() and q in self.pending:
+                self.pending.remove(q)
+        q.future.add_done_callback(forget)
+        self.loop.call_later(max(0, q.deadline - monotonic()), self.expire_pending)
+        return q
+
+    def query_many(self, cmds, **kwargs):
+        '''
+        Like Daq328p.query_many() but returns asyncio futures. Cancelling a
+        future drops its reply when it arrives.
+        '''
+        queries = []
+        for item in cmds:
+            if isinstance(item, (list, tuple)):
+                cmd, opts = item[0], dict(kwargs, **item[1])
+            else:
+                cmd, opts = item, kwargs
+            if not cmd.endswith('\n'):
+                cmd += '\n'
+            queries.append((cmd, opts))
+        untagged = [cmd for cmd, opts in queries if not opts.get('tag')]
+        if len(queries) > 1 and untagged:
+            raise ValueError('pipelined commands need a tag, %s has none' % untagged[0].strip())
+        queries = [(cmd, self.wait_reply(opts, cmd)) for cmd, opts in queries]
+        for _, q in queries:
+            # Untagged replies are what arrives after the command is sent
+            q.start = len(self.reply)
+        serial_error = self.send(''.join(cmd for cmd, _ in queries), CR=False)
+        if serial_error:
+            for _, q in queries:
+                self.pending.remove(q)
+                q.future.set_result((serial_error, ''))
+        return [q.future for _, q in queries]
+
+    @asyncio.coroutine
+    def query(self, cmd, **kwargs):
+        if cmd in HISTORY_COMMANDS and self.history is not None:
+            raise Return(self.history.query(cmd, **kwargs))
+        result = yield From(self.query_many([cmd], **kwargs)[0])
+        raise Return(result)
+
+    @asyncio.coroutine
+    def read(self, expected_text=''):
+        '''
+        Wait for expected_text without sending anything
+        '''
+        result = yield From(self.wait_reply({'expected_text': expected_text}).future)
+        self.publisher.set(self.namespace + 'daq328p-read', result[1])
+        raise Return(result)
+
+if __name__ == '__main__':
+    opt = docopt(__doc__)
+    loop = asyncio.get_event_loop()
+    daq = AsyncDaq328p(opt['--dev'], loop=loop)
+
+    @asyncio.coroutine
+    def main():
+        yield From(daq.start())
+        stream = daq.samples()
+        while True:
+            t, rows = yield From(stream.get())
+            print format_ns(t), rows
+
+    try:
+        loop.run_until_complete(main())
+    except KeyboardInterrupt:
+        pass
+    daq.close()
@@ -0,0 +1,352 @@
+"""bench.py -
+
+Benchmarks for the Daq328p serial path. The board is replaced by a pseudo
+terminal so no AVR (and no redis server) is needed. 'suite' runs the end
+to end benchmarks against the firmware simulator and can append its
+results to a file to track regressions.
+
+Usage:
+  bench.py reader [--lines=N] [--idle=SEC]
+  bench.py parser [--mbytes=MB]
+  bench.py frames [--samples=N]
+  bench.py submit [--readings=N]
+  bench.py manager [--boards=N] [--lines=N]
+  bench.py codec [--messages=N]
+  bench.py suite [--queries=N] [--rate=RATE] [--burst=N] [--seconds=SEC] [--redis=HOST] [--out=FILE]
+  bench.py (-h | --help)
+
+Options:
+  -h, --help
+  --lines=N     [default: 2000]
+  --idle=SEC    [default: 3]
+  --mbytes=MB   [default: 4]
+  --samples=N   [default: 200000]
+  --readings=N  [default: 2000]
+  --boards=N    [default: 16]
+  --queries=N   [default: 1000]
+  --rate=RATE   [default: 5000]
+  --burst=N     [default: 10]
+  --seconds=SEC [default: 5]
+  --messages=N  [default: 20000]
+
+"""
+
+import os
+import time
+import multiprocessing
+import threading
+
+from docopt import docopt
+from logbook import NullHandler
+
+import simplejson as sjson
+import requests
+
+import daq328p
+from framing import FrameParser, pack_samples
+from submit import Submitter, StubServer, SINGLE_URL
+from manager import AcquisitionManager
+from simulator import FirmwareSimulator, wait_ready
+from clock import monotonic, time_ns, format_ns
+from codec import CODECS
+from redis import Redis
+
+##########################################################################################
+class NullRedis(object):
+    '''
+    Stand-in for redis.Redis that records the time of every publish.
+    '''
+    def __init__(self):
+        self.published = []
+
+    def publish(self, channel, msg):
+        self.published.append(time.time())
+        return 0
+
+    def set(self, key, value):
+        return True
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def execute(self):
+        return []
+
+def open_board(reader='select', manager=None):
+    '''
+    Returns (Daq328p, master_fd) with the board side of a pty in master_fd
+    '''
+    master, slave = os.openpty()
+    daq328p.TIMEOUT = 0.05
+    daq328p.Daq328p.reader = reader
+    if manager is None:
+        D = daq328p.Daq328p(port=os.ttyname(slave), redis=NullRedis())
+    else:
+        D = manager.open(os.ttyname(slave))
+    D.redis = D.publisher.redis
+    return D, master
+
+def cpu_time():
+    t = os.times()
+    return t[0] + t[1]
+
+def bench_reader(reader, lines, idle):
+    D, master = open_board(reader)
+    D.start_thread()
+
+    # Idle CPU: nothing is written to the port
+    time.sleep(0.2)
+    c0, t0 = cpu_time(), time.time()
+    time.sleep(idle)
+    idle_cpu = (cpu_time() - c0) / (time.time() - t0)
+
+    # Line latency: one line at a time, wait for it to be published
+    sent = []
+    for i in range(lines):
+        sent.append(time.time())
+        os.write(master, 'line %d\r\n' % i)
+        while len(D.redis.published) <= i:
+            time.sleep(0.0001)
+    latency = sorted(p - s for s, p in zip(sent, D.redis.published))
+
+    D.close()
+    D.join(2)
+    os.close(master)
+    return idle_cpu, latency
+
+def sample_stream(nbytes):
+    '''
+    Mix of json sample frames and plain lines, roughly nbytes long
+    '''
+    frame = '<json>[["28ff6a4b00000012", 21.5], ["28ff6a4b00000034", 19.25]]</json>\r\n'
+    line = 'cmd>A ok\r\n'
+    block = (frame * 4 + line) * 16
+    return block * max(1, nbytes / len(block))
+
+def legacy_parse(chunks):
+    '''
+    Old Daq328p.run() loop: str concatenation, at most one line per read
+    '''
+    buff = ''
+    frames = 0
+    for data in chunks:
+        buff = buff + data
+        crlf_index = buff.find('\r\n')
+        if crlf_index > 0:
+            line = buff[0:crlf_index+2]
+            frames += 1
+            buff = buff[crlf_index+2:]
+    return frames, len(buff)
+
+def bench_parser(nbytes):
+    stream = sample_stream(nbytes)
+    # Bytes per 1 ms read at each line rate, plus 4k bursts
+    for label, chunk in [('115200', 12), ('921600', 92), ('3M', 300), ('burst', 4096)]:
+        chunks = [stream[i:i+chunk] for i in xrange(0, len(stream), chunk)]
+
+        parser = FrameParser()
+        to = time.time()
+        frames = 0
+        for data in chunks:
+            frames += len(parser.feed(data))
+        dt = time.time() - to
+
+        to = time.time()
+        legacy_frames, backlog = legacy_parse(chunks)
+        legacy_dt = time.time() - to
+
+        print "%-8s %10.2f %12d %12.2f %12d %12d" % (label, len(stream) / dt / 1e6, frames,
+            len(stream) / legacy_dt / 1e6, legacy_frames, backlog)
+
+def bench_frames(nsamples, per_frame=8):
+    '''
+    Host side decode cost of <json> text frames vs binary frames
+    '''
+    samples = [['28ff6a4b%08x' % k, 20.0 + k / 4.0] for k in range(per_frame)]
+    nframes = max(1, nsamples / per_frame)
+    text = ('<json>%s</json>\r\n' % sjson.dumps(samples)) * nframes
+    binary = pack_samples(samples) * nframes
+
+    to = time.time()
+    for kind, payload in FrameParser().feed(text):
+        sjson.loads(payload)
+    text_dt = time.time() - to
+
+    to = time.time()
+    FrameParser(binary=True).feed(binary)
+    binary_dt = time.time() - to
+
+    n = float(nframes * per_frame)
+    for label, dt, size in [('json', text_dt, len(text)), ('binary', binary_dt, len(binary))]:
+        print "%-8s %14.2f %14.1f %14.0f" % (label, 1e6 * dt / n, size / n, 11520 * n / size)
+
+def bench_codec(messages):
+    '''
+    Encode / decode cost and size of bridge commands, replies and sample
+    publishes in every codec
+    '''
+    t = time_ns()
+    payloads = [('command', {'from': 'Client 140234', 'id': 17, 'reply_to': 'reply:pi:1234:140234',
+                             'cmd': ['I', {'expected_text': 'cmd>'}, 1], 'timeout': 10, 't': time.time(),
+                             'codec': 'json'}),
+                ('reply', {'id': 17, 'out': [0, 'Daq328p 2013.12.15\r\ncmd>']}),
+                ('samples', [format_ns(t), [['28ff6a4b%08x' % k, 20.0 + k / 4.0] for k in range(8)], t])]
+    for name, obj in payloads:
+        for codec in sorted(CODECS.values(), key=lambda c: c.name):
+            data = codec.encode(obj)
+            to = time.time()
+            for k in xrange(messages):
+                codec.encode(obj)
+            encode_dt = time.time() - to
+            to = time.time()
+            for k in xrange(messages):
+                codec.decode(data)
+            decode_dt = time.time() - to
+            print "%-8s %-8s %10.2f %10.2f %8d" % (name, codec.name, 1e6 * encode_dt / messages,
+                                                  1e6 * decode_dt / messages, len(data))
+
+def bench_submit(readings):
+    '''
+    Readings/s into the stub sensordata api: old per-value GET vs Submitter
+    '''
+    server = StubServer().start()
+    rows = [['28ff6a4b%08d' % (k % 16), 20.0 + k % 7] for k in range(readings)]
+
+    to = time.time()
+    for sn, value in rows:
+        requests.get(SINGLE_URL % ('127.0.0.1', server.port, sn, value))
+    print "%-16s %12.0f %10d" % ('get per value', readings / (time.time() - to), server.requests)
+
+    for label, bulk in [('pooled per value', False), ('bulk', True)]:
+        server.requests = 0
+        S = Submitter('127.0.0.1', server.port, bulk=bulk, max_delay=0.05)
+        S.start()
+        to = time.time()
+        S.submit_many(rows)
+        S.stop(60)
+        print "%-16s %12.0f %10d" % (label, S.submitted / (time.time() - to), server.requests)
+    server.shutdown()
+
+def bench_manager(nboards, lines):
+    '''
+    N boards with one listener thread each vs one AcquisitionManager
+    '''
+    for label in ['threads', 'manager']:
+        manager = AcquisitionManager(redis=NullRedis()) if label == 'manager' else None
+        boards = [open_board(manager=manager) for k in range(nboards)]
+        if manager is not None:
+            manager.start()
+        else:
+            for D, master in boards:
+                D.start_thread()
+        published = boards[0][0].redis.published if manager else None
+        frame = '<json>[["28ff6a4b00000012", 21.5]]</json>\r\n'
+
+        c0, t0 = cpu_time(), time.time()
+        for k in range(lines):
+            for D, master in boards:
+                os.write(master, frame)
+        total = nboards * lines
+        while sum(len(D.redis.published) for D, master in boards[:1 if manager else nboards]) < total:
+            time.sleep(0.001)
+        dt = time.time() - t0
+        print "%-8s %8d %12.0f %10.2f" % (label, threading.active_count(), total / dt, (cpu_time() - c0) / dt)
+
+        if manager is not None:
+            manager.stop()
+        for D, master in boards:
+            D.close()
+            if manager is None:
+                D.join(2)
+            os.close(master)
+
+def bench_suite(queries, rate, burst, seconds, redis_host=None):
+    '''
+    End to end numbers against the firmware simulator, returns a dict
+    '''
+    results = {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'rate': rate, 'burst': burst}
+    redis = Redis(host=redis_host) if redis_host else NullRedis()
+
+    # Query latency, simulator in this process, nothing streaming
+    sim = FirmwareSimulator()
+    sim.start()
+    wait_ready(sim.port)
+    D = daq328p.Daq328p(port=sim.port, redis=redis)
+    D.start_thread()
+    latency = []
+    for k in range(queries):
+        to = monotonic()
+        D.query('I', expected_text='cmd>')
+        latency.append(monotonic() - to)
+    latency.sort()
+    for p in [50, 90, 99]:
+        results['query_p%d_ms' % p] = 1e3 * percentile(latency, p)
+    D.close()
+    D.join(2)
+    sim.stop()
+
+    # Streaming, simulator in a child process so its CPU is not counted
+    sim = FirmwareSimulator(rate=rate, burst=burst)
+    child = multiprocessing.Process(target=sim.run)
+    child.start()
+    if not wait_ready(sim.port):
+        raise RuntimeError('firmware simulator on %s does not answer' % sim.port)
+    D = daq328p.Daq328p(port=sim.port, redis=redis)
+    D.start_thread()
+    time.sleep(0.5)
+    frames0, commands0 = D.parser.frames, D.publisher.commands
+    c0, t0 = cpu_time(), time.time()
+    time.sleep(seconds)
+    dt = time.time() - t0
+    cpu = cpu_time() - c0
+    frames = D.parser.frames - frames0
+    published = D.publisher.commands - commands0
+    child.terminate()
+    child.join()
+    D.close()
+    D.join(2)
+    sim.stop()
+
+    results['lines_per_s'] = frames / dt
+    results['publish_per_s'] = published / dt
+    results['cpu_us_per_sample'] = 1e6 * cpu / max(1, frames)
+    results['cpu_load'] = cpu / dt
+    return results
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return float('nan')
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100.0))]
+
+if __name__ == '__main__':
+    opt = docopt(__doc__)
+    NullHandler().push_application()
+    if opt['reader']:
+        print "%-8s %10s %12s %12s %12s" % ('reader', 'idle cpu', 'p50 [ms]', 'p99 [ms]', 'max [ms]')
+        for reader in ['spin', 'select']:
+            idle_cpu, latency = bench_reader(reader, int(opt['--lines']), float(opt['--idle']))
+            print "%-8s %9.1f%% %12.3f %12.3f %12.3f" % (reader, 100 * idle_cpu,
+                1e3 * percentile(latency, 50), 1e3 * percentile(latency, 99), 1e3 * latency[-1])
+    elif opt['parser']:
+        print "%-8s %10s %12s %12s %12s %12s" % ('chunk', 'MB/s', 'frames', 'old MB/s', 'old frames', 'old backlog')
+        bench_parser(int(float(opt['--mbytes']) * 1e6))
+    elif opt['frames']:
+        print "%-8s %14s %14s %14s" % ('format', 'us/sample', 'bytes/sample', 'samples/s@115k')
+        bench_frames(int(opt['--samples']))
+    elif opt['submit']:
+        print "%-16s %12s %10s" % ('mode', 'readings/s', 'requests')
+        bench_submit(int(opt['--readings']))
+    elif opt['codec']:
+        print "%-8s %-8s %10s %10s %8s" % ('message', 'codec', 'enc [us]', 'dec [us]', 'bytes')
+        bench_codec(int(opt['--messages']))
+    elif opt['manager']:
+        print "%-8s %8s %12s %10s" % ('mode', 'threads', 'frames/s', 'cpu')
+        bench_manager(int(opt['--boards']), int(opt['--lines']))
+    elif opt['suite']:
+        results = bench_suite(int(opt['--queries']), float(opt['--rate']), int(opt['--burst']),
+                              float(opt['--seconds']), opt['--redis'])
+        for key in sorted(results):
+            print "%-20s %s" % (key, results[key])
+        if opt['--out']:
+            with open(opt['--out'], 'a') as f:
+                f.write(sjson.dumps(results) + '\n')
@@ -0,0 +1,73 @@
+"""capture.py -
+
+Raw serial capture files.
+
+A capture file keeps every chunk read from the serial port with the time
+it was read, so production traffic can be replayed offline (replay.py):
+
+    header  8 bytes   'D328CAP' + format version
+    record  12 bytes  <int64 time in ns since the epoch, uint32 length>
+            length bytes of serial data
+
+The file is flushed every flush_bytes bytes or flush_interval seconds of
+capture time, so a crash loses at most that much. read_capture() stops at
+a torn last record.
+"""
+
+import struct
+
+from threading import Lock
+from clock import time_ns
+
+MAGIC  = 'D328CAP\x01'
+RECORD = struct.Struct('<qI')
+
+##########################################################################################
+class CaptureWriter(object):
+
+    def __init__(self, path, flush_bytes=64 * 1024, flush_interval=1.0):
+        self.path        = path
+        self.file        = open(path, 'wb')
+        self.lock        = Lock()
+        self.chunks      = 0
+        self.bytes       = 0
+        self.flush_bytes = flush_bytes
+        self.flush_ns    = int(flush_interval * 1e9)
+        self.unflushed   = 0
+        self.flushed_at  = time_ns()
+        self.file.write(MAGIC)
+
+    def write(self, data, t=None):
+        if t is None:
+            t = time_ns()
+        with self.lock:
+            self.file.write(RECORD.pack(t, len(data)))
+            self.file.write(data)
+            self.chunks    += 1
+            self.bytes     += len(data)
+            self.unflushed += RECORD.size + len(data)
+            if self.unflushed >= self.flush_bytes or t - self.flushed_at >= self.flush_ns:
+                self.file.flush()
+                self.unflushed  = 0
+                self.flushed_at = t
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+def read_capture(path):
+    '''
+    Yields (time_ns, data) for every chunk in a capture file
+    '''
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a Daq328p capture file' % path)
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                break
+            t, n = RECORD.unpack(header)
+            data = f.read(n)
+            if len(data) < n:
+                break
+            yield t, data
@@ -0,0 +1,171 @@
+"""clock.py -
+
+Clocks and timed waits that do not depend on the wall clock or CPU time.
+
+Sample times are integer nanoseconds since the epoch (time_ns()) and are
+only turned into text where they leave the process (format_ns()).
+"""
+
+import os
+import time
+import heapq
+import select
+import itertools
+import ctypes
+import ctypes.util
+
+from datetime import datetime
+from threading import Thread, Lock
+
+CLOCK_MONOTONIC = 1
+TIMESTAMP_FORMAT = '%Y-%m-%d-%H:%M:%S'
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+def _librt_monotonic():
+    librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno=True)
+    clock_gettime = librt.clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+    ts = _timespec()
+
+    def monotonic():
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    monotonic()
+    return monotonic
+
+if hasattr(time, 'monotonic'):
+    monotonic = time.monotonic
+else:
+    try:
+        monotonic = _librt_monotonic()
+    except (OSError, AttributeError):
+        monotonic = time.time
+
+_epoch_ns = int(time.time() * 1e9) - int(monotonic() * 1e9)
+
+def time_ns():
+    '''
+    Nanoseconds since the epoch. Runs on the monotonic clock anchored to
+    the wall clock at import, so it never goes backwards.
+    '''
+    return int(monotonic() * 1e9) + _epoch_ns
+
+_formatted = (None, None, None)    # (fmt, second, text) of the last second formatted
+
+def format_ns(t, fmt=TIMESTAMP_FORMAT):
+    '''
+    Text form of a time_ns() value, text (e.g. from old spool files) is
+    returned as it is. The text of the whole second is cached, so the
+    frames of one second cost one strftime(); a trailing %f is appended
+    to it.
+    '''
+    global _formatted
+    if isinstance(t, basestring):
+        return t
+    second = t // 1000000000
+    fraction = fmt.endswith('%f')
+    last_fmt, last_second, text = _formatted
+    if second != last_second or fmt != last_fmt:
+        base = fmt[:-2] if fraction else fmt
+        if '%f' in base:
+            return datetime.fromtimestamp(second).replace(microsecond=t // 1000 % 1000000).strftime(fmt)
+        text = datetime.fromtimestamp(second).strftime(base)
+        _formatted = (fmt, second, text)
+    if fraction:
+        return text + '%06d' % (t // 1000 % 1000000)
+    return text
+
+##########################################################################################
+class Deadlines(Thread):
+    '''
+    One thread calling functions at monotonic deadlines, for every
+    wait_until() of the process. It sleeps in select() on a pipe, so the
+    deadline is met to the scheduler's precision and an earlier deadline
+    wakes it up.
+    '''
+
+    def __init__(self):
+        Thread.__init__(self)
+        self.setName('Deadlines-Thread')
+        self.daemon  = True
+        self.entries = []
+        self.seq     = itertools.count()
+        self.lock    = Lock()
+        self.wakeup  = os.pipe()
+        self.pid     = os.getpid()
+
+    def add(self, timeout, fn):
+        '''
+        Call fn() in timeout seconds, returns the entry to cancel()
+        '''
+        entry = [monotonic() + timeout, next(self.seq), fn]
+        with self.lock:
+            heapq.heappush(self.entries, entry)
+            earliest = self.entries[0] is entry
+        if earliest:
+            os.write(self.wakeup[1], 'x')
+        return entry
+
+    def cancel(self, entry):
+        entry[2] = None
+
+    def run(self):
+        while True:
+            with self.lock:
+                while self.entries and self.entries[0][2] is None:
+                    heapq.heappop(self.entries)
+                timeout = self.entries[0][0] - monotonic() if self.entries else None
+            if timeout is None or timeout > 0:
+                if self.wakeup[0] in select.select([self.wakeup[0]], [], [], timeout)[0]:
+                    os.read(self.wakeup[0], 512)
+                continue
+            with self.lock:
+                fn = heapq.heappop(self.entries)[2]
+            if fn is not None:
+                fn()
+
+_deadlines      = None
+_deadlines_lock = Lock()
+
+def deadlines():
+    '''
+    The Deadlines thread of this process, started on first use
+    '''
+    global _deadlines
+    with _deadlines_lock:
+        if _deadlines is None or _deadlines.pid != os.getpid():
+            _deadlines = Deadlines()
+            _deadlines.start()
+    return _deadlines
+
+def wait_until(condition, predicate, timeout):
+    '''
+    Wait on condition (held by the caller) until predicate() is true or
+    timeout seconds have passed. Returns the last value of predicate().
+
+    Python 2 implements Condition.wait(timeout) as a sleep loop that backs
+    off to 50 ms, so the wait itself is untimed and the shared Deadlines
+    thread notifies the condition at the deadline instead.
+    '''
+    result = predicate()
+    if result or timeout <= 0:
+        return result
+
+    deadline = monotonic() + timeout
+
+    def expire():
+        with condition:
+            condition.notify_all()
+
+    entry = deadlines().add(timeout, expire)
+    try:
+        while not result and monotonic() < deadline:
+            condition.wait()
+            result = predicate()
+    finally:
+        deadlines().cancel(entry)
+    return result
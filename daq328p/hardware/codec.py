@@ -0,0 +1,89 @@
+"""codec.py -
+
+Wire encodings of bridge messages and sample publishes.
+
+json is what every client and subscriber understands. msgpack is the
+compact fast path when it is installed. Encoded msgpack messages start
+with a 3 byte header: 0xc1 (never used by msgpack and never the start of
+json), the format version and the codec id, so decode() tells the
+encodings apart without being told which one was used.
+
+A bridge lists the codecs it can decode in the key '<channel>_codecs';
+Client.negotiate() picks the first of its preferred codecs found there,
+and keeps json with bridges that do not have the key.
+
+    codec = get_codec('msgpack')
+    data  = codec.encode({'cmd': 'I'})
+    decode(data)
+"""
+
+import simplejson as sjson
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MAGIC   = '\xc1'
+VERSION = 1
+
+##########################################################################################
+class JsonCodec(object):
+    name = 'json'
+
+    def encode(self, obj):
+        return sjson.dumps(obj)
+
+    def decode(self, data):
+        return sjson.loads(data)
+
+##########################################################################################
+class MsgpackCodec(object):
+    name = 'msgpack'
+    id   = 1
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError('MsgpackCodec needs msgpack')
+        self.header = MAGIC + chr(VERSION) + chr(self.id)
+
+    def encode(self, obj):
+        return self.header + msgpack.packb(obj, use_bin_type=False)
+
+    def decode(self, data):
+        if not data.startswith(self.header):
+            raise ValueError('not a version %d msgpack message' % VERSION)
+        return msgpack.unpackb(data[len(self.header):])
+
+CODECS = {'json': JsonCodec()}
+if msgpack is not None:
+    CODECS['msgpack'] = MsgpackCodec()
+BINARY = dict((codec.id, codec) for codec in CODECS.values() if hasattr(codec, 'id'))
+
+def get_codec(name):
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError('unknown codec %s, have %s' % (name, ', '.join(sorted(CODECS))))
+
+def codec_of(data):
+    '''
+    The codec data was encoded with
+    '''
+    if data[:1] != MAGIC:
+        return CODECS['json']
+    if len(data) < 3 or ord(data[1]) != VERSION or ord(data[2]) not in BINARY:
+        raise ValueError('unsupported message header %r' % data[:3])
+    return BINARY[ord(data[2])]
+
+def decode(data):
+    return codec_of(data).decode(data)
+
+def negotiate(offered, preferred):
+    '''
+    First codec of preferred that is also offered, json when none is
+    '''
+    for name in preferred:
+        if name in offered and name in CODECS:
+            return CODECS[name]
+    return CODECS['json']
@@ -15,37 +15,295 @@ Options:
 
 """
 
+import os
+import select
 import serial
 import struct
 import time
 import re
 import simplejson as sjson
 
-from threading import Thread,Event
+from threading import Thread, Event, Condition, Lock
 from Queue import Queue, Empty
 from warnings import *
 from datetime import datetime
 from logbook import Logger
 from docopt import docopt
-from requests import get
 from redis import Redis
+from publisher import BatchPublisher
+from submit import Submitter
+from spool import Spool
+from history import SensorHistory, HISTORY_COMMANDS
+from capture import CaptureWriter
+from framing import FrameParser, find_tagged, strip_frames
+from clock import monotonic, wait_until, time_ns, format_ns
+from futures import Future, TimeoutError
+from metrics import Metrics, MetricsReporter
+from codec import get_codec
+import tracing
 
 PARITY_NONE, PARITY_EVEN, PARITY_ODD = 'N', 'E', 'O'
 STOPBITS_ONE, STOPBITS_TWO = (1, 2)
 FIVEBITS, SIXBITS, SEVENBITS, EIGHTBITS = (5,6,7,8)
 TIMEOUT = 3
+MAX_REPLY = 65536
 
 log = Logger('daq328p')
 log.info("2013.12.15 20:23")
 
-class Daq328p(Thread):
+class PendingQuery(object):
+    '''
+    A query sent by Daq328p.query_many() that is waiting for its reply
+    '''
+    def __init__(self, kwargs, future=None, cmd=''):
+        self.cmd           = cmd.strip()
+        self.sent          = monotonic()
+        self.expected_text = kwargs.get('expected_text','\r\n')
+        self.tag           = kwargs.get('tag','')
+        self.json          = kwargs.get('json',0)
+        self.open_tag      = '<%s>' % self.tag
+        self.close_tag     = '</%s>' % self.tag
+        self.deadline      = self.sent + kwargs.get('timeout', TIMEOUT)
+        self.future        = future if future is not None else Future()
+        self.start         = 0      # untagged replies are looked for after this offset of the reply buffer
+
+    def expired(self):
+        return monotonic() >= self.deadline
+
+class Daq328pBase(object):
+    '''
+    Protocol handling shared by the threaded Daq328p and the asyncio
+    driver: matching replies to pending queries and publishing frames.
+    '''
+    submitter     = None
+    spool_dir     = None        # spool readings here until they are submitted
+    history_size  = 3600        # samples kept in memory per sensor, 0 disables the history
+    publish_batch = 100         # flush the redis pipeline after this many commands ...
+    publish_delay = 0.005       # ... or after this many seconds, whichever comes first
+    capture       = None        # CaptureWriter recording every chunk read from the port
+    metrics_interval = 10       # seconds between metrics snapshots written to redis, 0 disables them
+    reporter      = None
+    byte_ns       = 10 * 10**9 // 115200   # time one byte takes on the wire
+    pubsub_output = True        # PUBLISH frames on 'irq' and 'dac328p'
+    stream_output = False       # also XADD them to the 'irq:stream' and 'dac328p:stream' streams
+    codec         = 'json'      # encoding of published frames, see codec.py
+    timeout       = TIMEOUT     # seconds query() waits for a reply
+    last_chunk    = 0           # time_ns() of the last chunk read
+
+    def init_storage(self):
+        self.spool   = Spool(self.spool_dir) if self.spool_dir else None
+        self.history = None
+        if self.history_size:
+            try:
+                self.history = SensorHistory(self.history_size)
+            except ImportError as E:
+                log.warn('history disabled: %s' % E)
+
+    def init_metrics(self):
+        '''
+        Counters, per-command latency histograms and queue depths of this
+        board, see metrics.py
+        '''
+        self.metrics = M = Metrics()
+        if hasattr(self, 'pending'):
+            M.gauge('pending', lambda: len(self.pending))
+            M.gauge('reply_buffer', lambda: len(self.reply))
+        M.gauge('parser_buffer', lambda: len(self.parser.buffer) - self.parser.start)
+        M.gauge('parser_frames', lambda: self.parser.frames)
+        M.gauge('parser_dropped', lambda: self.parser.dropped)
+        M.gauge('parser_bad_frames', lambda: self.parser.bad_frames)
+        M.gauge('publish_queue', lambda: self.publisher.queue.qsize())
+        M.gauge('publish_errors', lambda: self.publisher.errors)
+        if self.spool is not None:
+            M.gauge('spool', lambda: len(self.spool))
+        M.gauge('submit_queue', lambda: self.submitter.queue.qsize() if self.submitter is not None else 0)
+
+    def start_metrics(self):
+        '''
+        Write metrics snapshots to the redis key '<namespace>daq328p-metrics'
+        every metrics_interval seconds, through the publisher
+        '''
+        if self.metrics_interval and self.reporter is None:
+            self.reporter = MetricsReporter(self.metrics, self.publisher, self.namespace + 'daq328p-metrics',
+                                            self.metrics_interval)
+            self.reporter.start()
+
+    def stop_metrics(self):
+        reporter, self.reporter = self.reporter, None
+        if reporter is not None:
+            reporter.stop()
+
+    def start_capture(self, path):
+        '''
+        Record every chunk read from the serial port to path, see capture.py
+        '''
+        self.stop_capture()
+        self.capture = CaptureWriter(path)
+        return self.capture
+
+    def stop_capture(self):
+        capture, self.capture = self.capture, None
+        if capture is not None:
+            capture.close()
+
+    def add_reply(self, data):
+        '''
+        Append received data to the reply buffer, keeping MAX_REPLY bytes
+        '''
+        self.reply += data
+        cut = len(self.reply) - MAX_REPLY
+        if cut > 0:
+            self.reply = self.reply[cut:]
+            for q in self.pending:
+                q.start = max(0, q.start - cut)
+
+    def match_replies(self, expire=False):
+        '''
+        Pair the data collected in self.reply with pending queries.
+        Daq328p must hold reply_ready, returns [(PendingQuery, data)].
+        With expire=True queries past their deadline get what is there.
+
+        Untagged queries only look at what arrived after they were sent,
+        without the sample frames streamed meanwhile.
+        '''
+        matched = []
+        for q in [q for q in self.pending if q.tag]:
+            start = self.reply.find(q.open_tag)
+            end = self.reply.find(q.close_tag, start) if start != -1 else -1
+            if end != -1:
+                matched.append((q, self.reply[start + len(q.open_tag):end]))
+                end += len(q.close_tag)
+                if self.reply.startswith('\r\n', end):
+                    end += 2
+                self.reply = self.reply[:start] + self.reply[end:]
+                for u in self.pending:
+                    if u.start >= end:
+                        u.start -= end - start
+                    elif u.start > start:
+                        u.start = start
+            elif expire and q.expired():
+                self.metrics.incr('query_timeouts')
+                matched.append((q, ''))
+
+        head = True
+        for q in [q for q in self.pending if not q.tag]:
+            text = strip_frames(self.reply[q.start:], [tag for tag, _, _ in self.parser.tags], self.parser.binary)
+            end = text.find(q.expected_text)
+            if end != -1:
+                end += len(q.expected_text)
+                matched.append((q, text[:end]))
+                self.reply = self.reply[:q.start] + text[end:]
+            elif expire and q.expired():
+                self.metrics.incr('query_timeouts')
+                # Same as read() timing out: the head gets the partial reply
+                matched.append((q, text if head else ''))
+                if head:
+                    self.reply = self.reply[:q.start]
+            else:
+                break
+            head = False
+
+        if matched:
+            done = [q for q, _ in matched]
+            self.pending = [q for q in self.pending if q not in done]
+        return matched
+
+    def resolve(self, matched):
+        now = monotonic()
+        for q, data in matched:
+            self.metrics.observe('query.%s' % q.cmd, now - q.sent)
+            if q.future.done():
+                # Cancelled by the caller, the reply is dropped
+                continue
+            try:
+                if q.json:
+                    data = sjson.loads(data)
+                q.future.set_result((0, data))
+            except Exception as E:
+                q.future.set_exception(E)
+
+    def process_chunk(self, data, t):
+        '''
+        Parse a chunk read at t (time_ns()) and publish its frames. The
+        frames are spread back over the time the chunk took on the wire,
+        so every sample gets its own increasing time.
+        '''
+        frames = self.parser.feed(data)
+        if frames:
+            n = len(frames)
+            span = max(0, min(t - self.last_chunk, len(data) * self.byte_ns))
+            for i, (kind, payload) in enumerate(frames):
+                self.process_frame(t - span * (n - 1 - i) // n, kind, payload)
+        self.last_chunk = t
+
+    def store_rows(self, t, rows):
+        '''
+        Add [[sn, ..., value], ...] to the history and keep them in the
+        spool until they are submitted, rows without sn and value are dropped
+        '''
+        rows = [row for row in rows if isinstance(row, (list, tuple)) and len(row) >= 2]
+        if self.history is not None:
+            self.history.add(rows, t / 1e9)
+        if self.spool is not None:
+            self.spool.append_many([[row[0], row[-1], t] for row in rows])
+            if self.submitter is not None:
+                self.submitter.wakeup.set()
+
+    def process_frame(self, t, kind, payload):
+        '''
+        Publish one frame returned by the FrameParser, t is a time_ns().
+        Messages are [timestamp text, data, t]. A frame that fails is
+        logged and dropped, it does not stop the listener.
+        '''
+        self.metrics.incr('frames.%s' % kind)
+        try:
+            self.dispatch_frame(t, kind, payload)
+        except Exception as E:
+            self.metrics.incr('frame_errors')
+            log.error('process_frame(%s): %s' % (kind, E))
+
+    def dispatch_frame(self, t, kind, payload):
+        if kind == 'json':
+            log.debug('Found json data in the buffer: %s' % payload)
+            try:
+                rows = sjson.loads(payload)
+            except Exception as E:
+                self.metrics.incr('json_errors')
+                log.error(E.message)
+                log.error("line %s" % payload)
+                self.publisher.publish(self.namespace + 'irq','<json>%s</json>' % payload)
+                self.metrics.incr('redis_publishes')
+                return
+            self.emit('irq', t, rows)
+            self.store_rows(t, rows)
+        elif kind == 'bin':
+            self.emit('irq', t, payload)
+            self.store_rows(t, payload)
+        else:
+            self.emit('dac328p', t, payload)
+
+    def emit(self, channel, t, data):
+        '''
+        Publish [timestamp text, data, t], encoded with codec, on
+        namespace + channel and, with stream_output, append it as
+        {'t', 'msg'} to the redis stream namespace + channel + ':stream'
+        '''
+        msg = get_codec(self.codec).encode([format_ns(t), data, t])
+        if self.pubsub_output:
+            self.publisher.publish(self.namespace + channel, msg)
+            self.metrics.incr('redis_publishes')
+        if self.stream_output:
+            self.publisher.xadd(self.namespace + channel + ':stream', {'t': t, 'msg': msg})
+            self.metrics.incr('stream_appends')
+
+class Daq328p(Thread, Daq328pBase):
     read_all_data = False
     submit_to     = 'sensoredweb.heroku.com'
     submit        = True
-    redis         = Redis()
     re_data       = re.compile(r'(?:<json>)(.*)(?:</json>)', re.DOTALL)
-    json_q        = Queue()
-    read_q        = Queue()
+    reader        = 'select'    # 'select' blocks on the port, 'spin' is the legacy inWaiting() listener loop
+    poll_interval = 0.5
+    binary        = False       # ask the firmware for binary sample frames at startup
     
     def __init__(self,
                  port = 8,
@@ -57,36 +315,75 @@ class Daq328p(Thread):
                  xonxoff=0,             
                  rtscts=0,              
                  writeTimeout=None,     
-                 dsrdtr=None            
+                 dsrdtr=None,
+                 redis=None,
+                 namespace='',
+                 publisher=None
                  ):
 
         '''
         Initialise the asynchronous serial object
+
+        namespace is prepended to every redis channel and key of this board,
+        publisher lets several boards share one BatchPublisher.
         '''
         
         Thread.__init__(self)
         self.serial = serial.Serial(port, baudrate, bytesize, parity, stopbits, packet_timeout, xonxoff, rtscts, writeTimeout, dsrdtr)
         
+        self.redis     = redis if redis is not None else Redis()
+        self.namespace = namespace
+        self.json_q    = Queue()
+        self.read_q    = Queue()
+        self.manager   = None
         self.running = Event()
-        self.buffer  = ''
+        self.parser  = FrameParser()
+        self._wakeup = os.pipe()
+        self.reply   = ''
+        self.reply_ready = Condition()
+        self.write_lock  = Lock()
+        self.pending = []
+        self.init_storage()
+        self.own_publisher = publisher is None
+        if self.own_publisher:
+            publisher = BatchPublisher(self.redis, self.publish_batch, self.publish_delay)
+            publisher.start()
+        self.publisher = publisher
+        self.byte_ns   = 10 * 10**9 // baudrate
+        self.init_metrics()
         self.log = Logger('Daq328p')
         log.info('Daq328p(is_alive=%d, serial_port_open=%d)' % (self.is_alive(), not self.serial.closed))
         out = self.query('I')
 
         if not out[0]:
             log.info(out[1])
+        if self.binary:
+            self.negotiate_binary()
 
     def __del__(self):
         log.debug("About to delete the object")
         self.close()
         log.debug("Closing serial interface")
         self.serial.close()
+        for fd in self._wakeup:
+            os.close(fd)
         if self.serial.closed:
             log.error("The serial connection still appears to be open")
         else:
             log.debug("The serial connection is closed")
         log.debug("Object deleted")
         
+    def negotiate_binary(self):
+        '''
+        Ask the firmware to switch to binary sample frames (command 'B1').
+        Firmware that supports them answers <mode>bin</mode>; anything else
+        keeps the <json> text protocol.
+        '''
+        out = self.query('B1', tag='mode')
+        self.parser.binary = not out[0] and out[1] == 'bin'
+        log.info('negotiate_binary() = %s' % self.parser.binary)
+        return self.parser.binary
+
     def start_thread(self):
         '''
         Open the serial serial bus to be read. This starts the listening
@@ -96,6 +393,15 @@ class Daq328p(Thread):
         self.serial.flushInput()
         self.running.set()
         self.start()
+        self.start_metrics()
+        if self.spool is not None and self.submit:
+            self.start_submitter()
+
+    def start_submitter(self):
+        if self.submitter is None:
+            self.submitter = Submitter(self.submit_to, spool=self.spool)
+            self.submitter.start()
+        return self.submitter
         
     def open(self):
         if not self.serial.isOpen():
@@ -117,13 +423,17 @@ class Daq328p(Thread):
             
         if self.open():
             try:
+                with self.reply_ready:
+                    if not self.pending:
+                        self.reply = ''
                 self.serial.write(data)
+                self.metrics.incr('bytes_out', len(data))
                 serial_error = 0
             except:
                 serial_error = 1
         else:
             serial_error = 2
-        self.redis.set('daq328p-send',data)
+        self.publisher.set(self.namespace + 'daq328p-send',data)
         return serial_error
     
     def read(self, expected_text=''):
@@ -137,26 +447,26 @@ class Daq328p(Thread):
         serial_data = ''
         if self.open():
             try:
-                to = time.clock()                
-                done = 0
-                while time.clock() - to < TIMEOUT and not done:
-                    if self.is_alive():
-                        if not self.read_q.empty():
-                            tmp = self.read_q.get_nowait()
-                            serial_data += tmp[1]
-                    else:                        
-                        n = self.serial.inWaiting()
-                        if n > 0:
-                            serial_data += self.serial.read(n)
-                    if expected_text in serial_data:
-                        done = 1
+                if self.listening():
+                    # The listener thread collects the reply and wakes us up
+                    with self.reply_ready:
+                        wait_until(self.reply_ready, lambda: expected_text in self.reply, TIMEOUT)
+                        serial_data, self.reply = self.reply, ''
+                else:
+                    deadline = monotonic() + TIMEOUT
+                    serial_data = self.read_chunk(0, reader='select')
+                    while expected_text not in serial_data:
+                        remaining = deadline - monotonic()
+                        if remaining <= 0:
+                            break
+                        serial_data += self.read_chunk(remaining, reader='select')
                 serial_error = 0
             except:
                 serial_error = 1
         else:
             serial_error = 2
         
-        self.redis.set('daq328p-read',serial_data)
+        self.publisher.set(self.namespace + 'daq328p-read',serial_data)
         return (serial_error, serial_data)
     
     def query(self,cmd, **kwargs):
@@ -172,19 +482,31 @@ class Daq328p(Thread):
         self.log.debug('query(cmd=%s, expected_text=%s, tag=%s,json=%d, delay=%d):' % \
             (cmd, expected_text, tag, json, delay))
 
+        if cmd in HISTORY_COMMANDS and self.history is not None:
+            return self.history.query(cmd, **kwargs)
+
+        if self.listening():
+            future = self.query_async(cmd, **kwargs)
+            time.sleep(delay)
+            try:
+                out = future.result(kwargs.get('timeout', self.timeout) + delay)
+            except TimeoutError:
+                self.forget([future])
+                out = (1, '')
+            tracing.mark('daq328p.reply')
+            return out
+
         query_data = ''
+        to = monotonic()
         self.send(cmd)
+        tracing.mark('daq328p.write')
         time.sleep(delay)
         out = self.read(expected_text)
+        tracing.mark('daq328p.reply')
+        self.metrics.observe('query.%s' % cmd.strip(), monotonic() - to)
         query_error = out[0]
         if tag:
-            pattern = re.compile(r'(?:<{0}>)(.*)(?:</{0}>)'.format(tag), re.DOTALL)
-            temp = pattern.findall(out[1])
-            if len(temp)>0:
-                query_data = temp[0]
-                query_error = 0
-            else:
-                query_data  = ''
+            query_data  = find_tagged(out[1], tag) or ''
             query_error = 0
         else:
             query_data = out[1]
@@ -192,12 +514,197 @@ class Daq328p(Thread):
             query_data = sjson.loads(query_data)
         return (query_error, query_data)
 
+    def query_async(self, cmd, **kwargs):
+        '''
+        Same as query() but returns a Future resolving to (error, data)
+        '''
+        return self.query_many([cmd], **kwargs)[0]
+
+    def query_many(self, cmds, **kwargs):
+        """
+        Send several commands in one write and return one Future per command.
+
+        cmds is a list of commands or (cmd, kwargs) pairs, kwargs are the
+        defaults for all of them. Replies are matched to commands in the
+        order they were sent; commands with a tag take the first <tag> frame
+        that arrives instead. Needs the listener thread (start_thread()).
+
+        Only one command without a tag is in flight at a time: a batch
+        of several commands needs a tag on each, and an untagged command
+        waits (up to its timeout) for the previous untagged one to finish.
+        """
+        queries = []
+        for item in cmds:
+            if isinstance(item, (list, tuple)):
+                cmd, opts = item[0], dict(kwargs, **item[1])
+            else:
+                cmd, opts = item, kwargs
+            if not cmd.endswith('\n'):
+                cmd += '\n'
+            queries.append((cmd, PendingQuery(dict({'timeout': self.timeout}, **opts), cmd=cmd)))
+        untagged = [q for _, q in queries if not q.tag]
+        if len(queries) > 1 and untagged:
+            raise ValueError('pipelined commands need a tag, %s has none' % untagged[0].cmd)
+
+        # Commands must reach the port in the order they are queued
+        with self.write_lock:
+            with self.reply_ready:
+                if untagged:
+                    wait_until(self.reply_ready, lambda: all(p.tag for p in self.pending),
+                               untagged[0].deadline - monotonic())
+                if not self.pending:
+                    self.reply = ''
+                for q in untagged:
+                    q.start = len(self.reply)
+                self.pending.extend(q for _, q in queries)
+            serial_error = self.send(''.join(cmd for cmd, _ in queries), CR=False)
+        tracing.mark('daq328p.write')
+        if serial_error:
+            with self.reply_ready:
+                self.pending = [q for q in self.pending if q not in [p for _, p in queries]]
+            for _, q in queries:
+                q.future.set_result((serial_error, ''))
+        return [q.future for _, q in queries]
+
+    def forget(self, futures):
+        '''
+        Drop the pending queries of futures, e.g. after query() timed out,
+        so their late replies are not taken for the next query's
+        '''
+        with self.reply_ready:
+            self.pending = [q for q in self.pending if q.future not in futures]
+            self.reply_ready.notify_all()
+        for future in futures:
+            future.cancel()
+
+    @property
+    def concurrency(self):
+        '''
+        How many threads may call query() at once, see HwRedisInterface.
+        Replies are only matched concurrently by the listener thread.
+        '''
+        return 4 if self.listening() else 1
+
+    def poll_timeout(self):
+        '''
+        How long the listener may sleep before a pending query expires
+        '''
+        with self.reply_ready:
+            if not self.pending:
+                return self.poll_interval
+            deadline = min(q.deadline for q in self.pending)
+        return max(0, min(self.poll_interval, deadline - monotonic()))
+
     def close(self):
         '''
-        Close the listening thread.
+        Close the listening thread. Without one (e.g. a board of an
+        AcquisitionManager) the capture and publisher are stopped here.
         '''
         log.debug('close() - closing the worker thread')
         self.running.clear()
+        if self.manager is not None:
+            self.manager.remove(self)
+        self.stop_metrics()
+        if not self.is_alive():
+            self.stop_capture()
+            self.stop_publisher()
+        if self.submitter is not None:
+            self.submitter.stop()
+        try:
+            os.write(self._wakeup[1], 'x')
+        except OSError:
+            pass
+
+    def listening(self):
+        '''
+        True when received data is handled by the listener thread or an
+        AcquisitionManager rather than read directly by read()
+        '''
+        return self.manager is not None or (self.is_alive() and self.running.isSet())
+
+    def stop_publisher(self):
+        if self.own_publisher:
+            self.publisher.stop()
+
+    def read_chunk(self, timeout=None, reader=None):
+        '''
+        Wait up to timeout (default poll_interval) seconds for data on the
+        serial port and return whatever is available.
+
+        In 'select' mode the thread sleeps in select() on the port and the
+        wakeup pipe, so an idle board costs no CPU and close() returns the
+        thread immediately. Returns '' when nothing arrived. reader
+        overrides self.reader, read() always waits in select().
+        '''
+        if (reader or self.reader) == 'spin':
+            n = self.serial.inWaiting()
+            return self.serial.read(n) if n else ''
+
+        try:
+            fd = self.serial.fileno()
+        except (AttributeError, ValueError):
+            fd = None
+
+        if timeout is None:
+            timeout = self.poll_interval
+        if fd is None:
+            # No file descriptor (e.g. a socket:// url): block in read() with a
+            # timeout, restored so later read()/query() calls are unaffected
+            saved = self.serial.timeout
+            self.serial.timeout = timeout
+            try:
+                data = self.serial.read(1)
+            finally:
+                self.serial.timeout = saved
+        else:
+            ready = select.select([fd, self._wakeup[0]], [], [], timeout)[0]
+            if self._wakeup[0] in ready:
+                os.read(self._wakeup[0], 512)
+            if fd not in ready:
+                return ''
+            data = ''
+        n = self.serial.inWaiting()
+        if n:
+            data += self.serial.read(n)
+        return data
+
+    def deliver(self, data):
+        '''
+        Hand data received by the listener thread to a waiting read()
+        '''
+        with self.reply_ready:
+            self.add_reply(data)
+            matched = self.match_replies() if self.pending else []
+            self.reply_ready.notify_all()
+        self.resolve(matched)
+
+    def handle_data(self, data, t=None):
+        '''
+        Everything done with a chunk read from the serial port: wake up
+        waiting queries, parse it and publish the frames. t is when the
+        chunk was read, default now.
+        '''
+        if t is None:
+            t = time_ns()
+        if self.capture is not None:
+            self.capture.write(data, t)
+        self.metrics.incr('bytes_in', len(data))
+        self.deliver(data)
+        self.process_chunk(data, t)
+
+    def expire_pending(self):
+        if self.pending:
+            with self.reply_ready:
+                matched = self.match_replies(expire=True)
+                self.reply_ready.notify_all()
+            self.resolve(matched)
+
+    def fail_pending(self):
+        with self.reply_ready:
+            pending, self.pending = self.pending, []
+            self.reply_ready.notify_all()
+        for q in pending:
+            q.future.set_result((1, ''))
 
     def run(self):
         '''
@@ -208,41 +715,17 @@ class Daq328p(Thread):
         try:
             log.debug('Starting the listner thread')
             while(self.running.isSet()):
-                bytes_in_waiting = self.serial.inWaiting()
-                if bytes_in_waiting:
-                    new_data = self.serial.read(bytes_in_waiting)            
-                    self.buffer = self.buffer + new_data
-                    
-                    crlf_index = self.buffer.find('\r\n')
-                    if crlf_index > 0:
-                        line = self.buffer[0:crlf_index+2]                        
-                        
-                        # Put the unpacked data onto the read queue                    
-                        timestamp = datetime.now().strftime('%Y-%m-%d-%H:%M:%S')                        
-                        
-                        if '</json>' in line:
-                            log.debug('Found json data in the buffer: %s' % line)
-                            temp = self.re_data.findall(line)
-                            try:
-                                final_data = [timestamp, sjson.loads(temp[0])]
-                                #self.json_q.put(final_data)
-                                self.redis.publish('irq',sjson.dumps(final_data))
-                            except Exception as E:
-                                log.error(E.message)
-                                log.error("line %s" % line)
-                                final_data = [timestamp, "json loads error"] 
-                                self.redis.publish('irq',line)
-                                #self.read_q.put([timestamp, line])
-                        else:
-                            final_data = [timestamp, line]
-                            self.redis.publish('dac328p',sjson.dumps(final_data))
-                            #self.read_q.put([timestamp, line])
-
-                        self.buffer = self.buffer[crlf_index+2:]
+                new_data = self.read_chunk(self.poll_timeout())
+                self.expire_pending()
+                if new_data:
+                    self.handle_data(new_data)
 
         except Exception as E:
             log.error("Exception occured, within the run function: %s" % E.message)
         
+        self.fail_pending()
+        self.stop_capture()
+        self.stop_publisher()
         log.debug('Exiting run() function')
 
 ############################################################################################
@@ -253,19 +736,7 @@ class Daq328p(Thread):
             q_data = self.json_q.get(1,1)
             log.debug('q_data = %s' % str(q_data[1]))
             if self.submit:
-                try:
-                    for data in q_data[1]:
-                        url = 'http://%s:8000/sensordata/api/submit/datavalue/now/sn/%s/val/%s' % (self.submit_to, data[0], data[-1])
-                        log.debug('submitting to: %s' % url)
-                        
-                        res = get(url)
-                        if res.ok:
-                            log.info(res.content)
-                        else:
-                            log.info(res)
-                except Exception as E:
-                    log.error("Exception occured, within the process_q() function: %s" % E.message)
-                    log.error('q_data = %s' % str(q_data[1]))
+                self.start_submitter().submit_many(q_data[1], q_data[0])
             else:
                 pass
         else    :
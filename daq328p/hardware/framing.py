@@ -0,0 +1,208 @@
+"""framing.py -
+
+Incremental frame parser for the Daq328p serial stream.
+
+The firmware sends CRLF terminated text lines and <json>...</json> frames.
+FrameParser keeps the unparsed bytes in a bytearray and returns every
+complete frame found in each chunk, so frames split across reads are
+reassembled and a burst of lines costs one pass over the new data.
+
+With binary=True the parser also accepts packed sample frames:
+
+    sync    2 bytes   0xA5 0x5A
+    version 1 byte    BIN_VERSION
+    count   1 byte    number of records
+    records count x   <8 byte onewire serial, float32 value>, little endian
+    cksum   1 byte    sum of version, count and record bytes mod 256
+
+The serial is handed on as the hex text the <json> frames carry, so
+readings land under the same sensor whichever framing sent them.
+
+0xA5 never shows up in the ASCII text protocol, so binary frames can be
+interleaved with lines and <json> frames.
+
+An open tag without its close tag (a corrupted or dropped </json>) is
+given up on when another open tag shows up first or after max_open bytes:
+only the bad open tag is dropped and parsing resyncs on what follows.
+"""
+
+import struct
+import binascii
+
+CRLF = '\r\n'
+SYNC = '\xa5\x5a'
+BIN_VERSION = 2
+BIN_HEADER  = struct.Struct('<2sBB')
+BIN_RECORD  = struct.Struct('<8sf')
+
+##########################################################################################
+class FrameParser(object):
+    '''
+    parser = FrameParser()
+    for kind, payload in parser.feed(chunk):
+        ...
+
+    kind is 'line' for a plain CRLF terminated line (payload keeps the CRLF),
+    the tag name for a <tag>...</tag> frame (payload is the text between
+    the tags) or 'bin' for a binary frame (payload is a list of (sn, value)).
+    Blank lines are dropped.
+    '''
+
+    def __init__(self, tags=('json',), max_frame=65536, max_open=4096, binary=False):
+        self.tags       = [(tag, '<%s>' % tag, '</%s>' % tag) for tag in tags]
+        self.max_frame  = max_frame
+        self.max_open   = max_open
+        self.binary     = binary
+        self.buffer     = bytearray()
+        self.start      = 0
+        self.dropped    = 0
+        self.frames     = 0
+        self.bad_frames = 0
+
+    def __len__(self):
+        return len(self.buffer) - self.start
+
+    def reset(self):
+        del self.buffer[:]
+        self.start = 0
+
+    def pending(self):
+        return str(self.buffer[self.start:])
+
+    def _finder(self, buf):
+        '''
+        find(pattern, start) that remembers the last hit of each pattern, the
+        buffer does not change during one feed() so no byte is scanned twice
+        '''
+        hits = {}
+        def find(pattern, start):
+            i = hits.get(pattern)
+            if i is None or (i != -1 and i < start):
+                i = hits[pattern] = buf.find(pattern, start)
+            return i
+        return find
+
+    def feed(self, data):
+        '''
+        Append data to the buffer and return the list of complete frames
+        '''
+        buf = self.buffer
+        buf += data
+        frames = []
+        start = self.start
+        size = len(buf)
+        find = self._finder(buf)
+
+        while start < size:
+            self.start = start
+            crlf = find(CRLF, start)
+            end = size if crlf == -1 else crlf
+            sync = find(SYNC, start) if self.binary else -1
+            if sync >= end:
+                sync = -1
+            else:
+                end = sync if sync != -1 else end
+            i = -1
+            for tag_i, open_i, close_i in self.tags:
+                k = find(open_i, start)
+                if k != -1 and k < end:
+                    i, tag, open_tag, close_tag = k, tag_i, open_i, close_i
+                    end = k
+
+            if i != -1:
+                body = i + len(open_tag)
+                close = buf.find(close_tag, body)
+                limit = close if close != -1 else size
+                reopen = any(buf.find(open_k, body, limit) != -1 for _, open_k, _ in self.tags)
+                if reopen or (close == -1 and size - body > self.max_open):
+                    # Unterminated frame, drop the open tag and resync after it
+                    self.bad_frames += 1
+                    if i > start and buf[start:i].strip():
+                        frames.append(('line', str(buf[start:i])))
+                    start = body
+                    continue
+                if close == -1:
+                    break
+                if i > start and buf[start:i].strip():
+                    frames.append(('line', str(buf[start:i])))
+                frames.append((tag, str(buf[i + len(open_tag):close])))
+                start = close + len(close_tag)
+                if buf.startswith(CRLF, start):
+                    start += 2
+            elif sync != -1:
+                if sync + BIN_HEADER.size > size:
+                    break
+                count = buf[sync + 3]
+                frame_end = sync + BIN_HEADER.size + count * BIN_RECORD.size + 1
+                if frame_end > size:
+                    break
+                if sync > start and buf[start:sync].strip():
+                    frames.append(('line', str(buf[start:sync])))
+                if buf[sync + 2] == BIN_VERSION and sum(buf[sync + 2:frame_end - 1]) & 0xff == buf[frame_end - 1]:
+                    frames.append(('bin', unpack_records(buf, sync + BIN_HEADER.size, count)))
+                    start = frame_end
+                    if buf.startswith(CRLF, start):
+                        start += 2
+                else:
+                    # Bad checksum or a stray sync byte, resync after it
+                    self.bad_frames += 1
+                    start = sync + 1
+            elif crlf != -1:
+                if crlf > start:
+                    frames.append(('line', str(buf[start:crlf + 2])))
+                start = crlf + 2
+            else:
+                break
+
+        if size - start > self.max_frame:
+            # Garbage without a terminator, do not let it grow without bound
+            self.dropped += size - start
+            start = size
+
+        if start == size:
+            del buf[:]
+            start = 0
+        elif start > 4096 and start > size / 2:
+            del buf[:start]
+            start = 0
+        self.start = start
+        self.frames += len(frames)
+        return frames
+
+_record_structs = {}
+
+def unpack_records(buf, offset, count):
+    '''
+    Decode count binary records starting at offset into [(sn, value), ...]
+    '''
+    fmt = _record_structs.get(count)
+    if fmt is None:
+        fmt = _record_structs[count] = struct.Struct('<' + '8sf' * count)
+    values = fmt.unpack_from(buf, offset)
+    return zip(map(binascii.hexlify, values[0::2]), values[1::2])
+
+def pack_samples(samples):
+    '''
+    Build a binary frame from [[sn, value], ...], sn in hex, the firmware side of unpack_records()
+    '''
+    body = struct.pack('<BB', BIN_VERSION, len(samples))
+    body += ''.join(BIN_RECORD.pack(binascii.unhexlify(sn), value) for sn, value in samples)
+    return SYNC + body + chr(sum(bytearray(body)) & 0xff)
+
+def strip_frames(data, tags=('json',), binary=False):
+    '''
+    data without its complete tagged and binary frames and blank lines,
+    e.g. without the samples streamed while a command waited for its reply
+    '''
+    parser = FrameParser(tags=tags, binary=binary)
+    lines = [payload for kind, payload in parser.feed(data) if kind == 'line']
+    return ''.join(lines) + parser.pending()
+
+def find_tagged(data, tag):
+    '''
+    Returns the payload of the first <tag>...</tag> frame in data or None
+    '''
+    for kind, payload in FrameParser(tags=(tag,)).feed(data + CRLF):
+        if kind == tag:
+            return payload
+    return None
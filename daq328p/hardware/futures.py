@@ -0,0 +1,83 @@
+"""futures.py -
+
+Minimal thread safe Future used to hand replies from listener threads to
+callers waiting on them.
+"""
+
+from threading import Condition
+from clock import wait_until
+
+class TimeoutError(Exception):
+    pass
+
+class CancelledError(Exception):
+    pass
+
+##########################################################################################
+class Future(object):
+
+    def __init__(self):
+        self._cond      = Condition()
+        self._done      = False
+        self._result    = None
+        self._exception = None
+        self._callbacks = []
+
+    def __repr__(self):
+        return '<Future done=%s>' % self._done
+
+    def done(self):
+        return self._done
+
+    def cancelled(self):
+        return isinstance(self._exception, CancelledError)
+
+    def _finish(self, result, exception):
+        with self._cond:
+            if self._done:
+                return False
+            self._result    = result
+            self._exception = exception
+            self._done      = True
+            self._cond.notify_all()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+        return True
+
+    def set_result(self, result):
+        return self._finish(result, None)
+
+    def set_exception(self, exception):
+        return self._finish(None, exception)
+
+    def cancel(self):
+        return self._finish(None, CancelledError())
+
+    def add_done_callback(self, fn):
+        with self._cond:
+            if not self._done:
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def wait(self, timeout=None):
+        with self._cond:
+            if timeout is None:
+                while not self._done:
+                    self._cond.wait()
+            else:
+                wait_until(self._cond, lambda: self._done, timeout)
+            return self._done
+
+    def exception(self, timeout=None):
+        if not self.wait(timeout):
+            raise TimeoutError()
+        return self._exception
+
+    def result(self, timeout=None):
+        if not self.wait(timeout):
+            raise TimeoutError()
+        if self._exception is not None:
+            raise self._exception
+        return self._result
@@ -0,0 +1,165 @@
+"""history.py -
+
+In-memory sample history per sensor.
+
+Every sensor gets a fixed size NumPy ring buffer of (time, value) pairs, so
+appends are O(1) and memory stays bounded however long the process runs.
+Window statistics are computed with vectorized NumPy operations. The
+number of sensors is capped as well; the sensor updated least recently is
+forgotten first.
+"""
+
+import time
+
+from threading import Lock
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+HISTORY_COMMANDS = ('history', 'history_last', 'history_buckets', 'sensors')
+
+##########################################################################################
+class RingBuffer(object):
+
+    def __init__(self, size):
+        self.size  = size
+        self.t     = np.zeros(size, np.float64)
+        self.v     = np.zeros(size, np.float64)
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def append(self, t, v):
+        i = self.count % self.size
+        self.t[i] = t
+        self.v[i] = v
+        self.count += 1
+
+    def arrays(self):
+        '''
+        Returns (t, v) in time order, oldest first
+        '''
+        if self.count <= self.size:
+            return self.t[:self.count], self.v[:self.count]
+        i = self.count % self.size
+        return np.roll(self.t, -i), np.roll(self.v, -i)
+
+    def window(self, since=None):
+        t, v = self.arrays()
+        if since is not None:
+            first = np.searchsorted(t, since)
+            t, v = t[first:], v[first:]
+        return t, v
+
+##########################################################################################
+class SensorHistory(object):
+    '''
+    H = SensorHistory(size=3600)
+    H.add([[sn, ..., value], ...])
+    H.stats(sn, seconds=600)
+    '''
+
+    def __init__(self, size=3600, max_sensors=256):
+        if np is None:
+            raise ImportError('SensorHistory needs numpy')
+        self.size        = size
+        self.max_sensors = max_sensors
+        self.buffers     = {}
+        self.updated     = {}
+        self.lock        = Lock()
+
+    def sensors(self):
+        with self.lock:
+            return sorted(self.buffers.keys())
+
+    def add(self, rows, t=None):
+        '''
+        Append [[sn, ..., value], ...] as sent by the firmware, t defaults to now.
+        Rows that are not a sequence of at least sn and value, or whose value
+        is not a number, are skipped.
+        '''
+        if t is None:
+            t = time.time()
+        with self.lock:
+            for row in rows:
+                if not isinstance(row, (list, tuple)) or len(row) < 2:
+                    continue
+                try:
+                    value = float(row[-1])
+                except (TypeError, ValueError):
+                    continue
+                sn = str(row[0])
+                buff = self.buffers.get(sn)
+                if buff is None:
+                    if self.updated and len(self.buffers) >= self.max_sensors:
+                        oldest = min(self.updated, key=self.updated.get)
+                        del self.buffers[oldest], self.updated[oldest]
+                    buff = self.buffers[sn] = RingBuffer(self.size)
+                buff.append(t, value)
+                self.updated[sn] = t
+
+    def window(self, sn, seconds=None):
+        '''
+        Returns copies of (t, v) for the last seconds (default everything kept)
+        '''
+        with self.lock:
+            buff = self.buffers.get(str(sn))
+            if buff is None:
+                return np.zeros(0), np.zeros(0)
+            since = None if seconds is None else time.time() - seconds
+            t, v = buff.window(since)
+            return t.copy(), v.copy()
+
+    def stats(self, sn, seconds=None):
+        t, v = self.window(sn, seconds)
+        if not len(v):
+            return {'sn': sn, 'count': 0}
+        return {'sn'   : sn,
+                'count': int(len(v)),
+                'first': float(t[0]),
+                'last' : float(t[-1]),
+                'min'  : float(v.min()),
+                'max'  : float(v.max()),
+                'mean' : float(v.mean()),
+                'std'  : float(v.std()),
+                'value': float(v[-1])}
+
+    def last(self, sn, n=10):
+        t, v = self.window(sn)
+        return np.column_stack((t[-n:], v[-n:])).tolist()
+
+    def buckets(self, sn, seconds=3600, width=60):
+        '''
+        Per bucket [start, count, min, max, mean] over the last seconds
+        '''
+        t, v = self.window(sn, seconds)
+        if not len(v):
+            return []
+        bucket = np.floor(t / width).astype(np.int64)
+        starts = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+        counts = np.diff(np.r_[starts, len(v)])
+        return np.column_stack((bucket[starts] * float(width), counts,
+                                np.minimum.reduceat(v, starts),
+                                np.maximum.reduceat(v, starts),
+                                np.add.reduceat(v, starts) / counts)).tolist()
+
+    def query(self, cmd, **kwargs):
+        '''
+        Bridge entry point for the HISTORY_COMMANDS, returns (error, data)
+        '''
+        try:
+            if cmd == 'sensors':
+                return (0, self.sensors())
+            sn = kwargs['sn']
+            if cmd == 'history':
+                return (0, self.stats(sn, kwargs.get('seconds')))
+            if cmd == 'history_last':
+                return (0, self.last(sn, int(kwargs.get('n', 10))))
+            if cmd == 'history_buckets':
+                return (0, self.buckets(sn, float(kwargs.get('seconds', 3600)), float(kwargs.get('width', 60))))
+        except Exception as E:
+            return (1, str(E))
+        return (1, 'unknown history command %s' % cmd)
@@ -1,4 +1,5 @@
 import insteon
+import tracing
 from logbook import Logger
 
 ##########################################################################################
@@ -14,9 +15,11 @@ class InsteonCli(object):
         return str(self)
 
     def query(self, cmd, *args, **kwargs):
+        tracing.mark('insteon.start')
     	try:
         	insteon_method = getattr(self.plm, cmd)
         	result = [0, insteon_method(**kwargs)]
         except Exception as e:
         	result = [1, e.message]
+        tracing.mark('insteon.end')
         return result
\ No newline at end of file
@@ -0,0 +1,151 @@
+"""manager.py -
+
+Serve many Daq328p boards from one thread.
+
+AcquisitionManager polls the serial ports of all its boards in a single
+poll() loop instead of running one listener thread per port. Each board
+keeps its own parser, reply buffer and redis namespace; all boards share
+one redis connection and one BatchPublisher.
+
+Usage:
+  manager.py DEV...
+  manager.py (-h | --help)
+
+"""
+
+import os
+import select
+import time
+
+from threading import Thread, Event, Lock
+from logbook import Logger
+from docopt import docopt
+from redis import Redis
+
+from daq328p import Daq328p
+from publisher import BatchPublisher
+
+POLL_IN  = select.POLLIN | select.POLLPRI
+POLL_ERR = select.POLLERR | select.POLLHUP | select.POLLNVAL
+
+##########################################################################################
+class AcquisitionManager(Thread):
+    '''
+    M = AcquisitionManager()
+    M.open('/dev/ttyUSB0')                    # channels 'ttyUSB0:irq', ...
+    M.open('/dev/ttyUSB1', namespace='attic:')
+    M.start()
+    '''
+
+    def __init__(self, redis=None, poll_interval=0.5):
+        Thread.__init__(self)
+        self.setName('AcquisitionManager-Thread')
+        self.daemon        = True
+        self.redis         = redis if redis is not None else Redis()
+        self.poll_interval = poll_interval
+        self.publisher     = BatchPublisher(self.redis, Daq328p.publish_batch, Daq328p.publish_delay)
+        self.publisher.start()
+        self.boards        = {}
+        self.lock          = Lock()
+        self.running       = Event()
+        self.running.set()
+        self.poller        = select.poll()
+        self._wakeup       = os.pipe()
+        self.poller.register(self._wakeup[0], POLL_IN)
+        self.Log           = Logger('AcquisitionManager')
+
+    def __len__(self):
+        return len(self.boards)
+
+    def open(self, port, namespace=None, **kwargs):
+        '''
+        Open a Daq328p on port and add it to the loop
+        '''
+        if namespace is None:
+            namespace = '%s:' % os.path.basename(str(port))
+        board = Daq328p(port, redis=self.redis, namespace=namespace, publisher=self.publisher, **kwargs)
+        self.add(board)
+        return board
+
+    def add(self, board):
+        fd = board.serial.fileno()
+        with self.lock:
+            self.boards[fd] = board
+            self.poller.register(fd, POLL_IN)
+        board.manager = self
+        board.start_metrics()
+        self.wake()
+        self.Log.info('add(%s, namespace=%s)' % (board.serial.port, board.namespace))
+
+    def remove(self, board):
+        with self.lock:
+            for fd, b in self.boards.items():
+                if b is board:
+                    del self.boards[fd]
+                    self.poller.unregister(fd)
+        board.manager = None
+        board.fail_pending()
+        self.wake()
+
+    def wake(self):
+        try:
+            os.write(self._wakeup[1], 'x')
+        except OSError:
+            pass
+
+    def stop(self, timeout=2):
+        self.running.clear()
+        self.wake()
+        if self.is_alive():
+            self.join(timeout)
+        for board in self.boards.values():
+            # Leaves the loop, stops its metrics, capture and submitter
+            board.close()
+            board.serial.close()
+        self.publisher.stop()
+
+    def poll_timeout(self):
+        timeout = self.poll_interval
+        for board in self.boards.values():
+            timeout = min(timeout, board.poll_timeout())
+        return timeout
+
+    def read(self, fd, events):
+        board = self.boards.get(fd)
+        if board is None:
+            return
+        if events & POLL_ERR and not events & POLL_IN:
+            self.Log.error('read(%s) port closed or in error, removing it' % board.serial.port)
+            self.remove(board)
+            return
+        try:
+            n = board.serial.inWaiting()
+            if n:
+                board.handle_data(board.serial.read(n))
+        except Exception as E:
+            self.Log.error('read(%s): %s' % (board.serial.port, E))
+
+    def run(self):
+        self.Log.debug('run()')
+        while self.running.isSet():
+            for fd, events in self.poller.poll(1000 * self.poll_timeout()):
+                if fd == self._wakeup[0]:
+                    os.read(fd, 512)
+                else:
+                    self.read(fd, events)
+            for board in self.boards.values():
+                board.expire_pending()
+        self.Log.debug('end of run()')
+
+if __name__ == '__main__':
+    opt = docopt(__doc__)
+    M = AcquisitionManager()
+    for dev in opt['DEV']:
+        M.open(dev)
+    M.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    M.stop()
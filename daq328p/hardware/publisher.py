@@ -0,0 +1,106 @@
+"""publisher.py -
+
+Batched redis publishing for the acquisition threads.
+
+Messages are queued by the caller and written by a background thread
+through a non-transactional redis pipeline. A batch is flushed when it
+holds max_batch commands or when the oldest command has waited max_delay
+seconds, whichever comes first, so serial ingestion never waits on a redis
+round trip.
+
+xadd() appends to a redis stream (XADD with approximate MAXLEN trimming),
+sent with execute_command() so it works with clients that predate streams.
+publish_json() leaves the json encoding of the message to the thread too.
+"""
+
+import time
+import simplejson as sjson
+
+from threading import Thread
+from Queue import Queue, Empty
+from logbook import Logger
+
+##########################################################################################
+class BatchPublisher(Thread):
+
+    def __init__(self, redis, max_batch=100, max_delay=0.005, stream_maxlen=100000):
+        Thread.__init__(self)
+        self.setName('BatchPublisher-Thread')
+        self.daemon        = True
+        self.redis         = redis
+        self.max_batch     = max_batch
+        self.max_delay     = max_delay
+        self.stream_maxlen = stream_maxlen
+        self.queue         = Queue()
+        self.flushes       = 0
+        self.commands      = 0
+        self.errors        = 0
+        self.Log           = Logger('BatchPublisher')
+
+    def publish(self, channel, msg):
+        self.queue.put(('publish', channel, msg))
+
+    def publish_json(self, channel, obj):
+        self.queue.put(('publish_json', channel, obj))
+
+    def set(self, key, value):
+        self.queue.put(('set', key, value))
+
+    def xadd(self, stream, fields):
+        '''
+        Append {field: value} to stream, keeping about stream_maxlen entries
+        '''
+        self.queue.put(('xadd', stream, fields))
+
+    def stop(self, timeout=2):
+        '''
+        Flush whatever is queued and stop the thread
+        '''
+        self.queue.put(None)
+        if self.is_alive():
+            self.join(timeout)
+
+    def flush(self, batch):
+        pipe = self.redis.pipeline(transaction=False)
+        for op, key, value in batch:
+            if op == 'xadd':
+                args = []
+                for field, v in value.items():
+                    args.extend((field, v))
+                pipe.execute_command('XADD', key, 'MAXLEN', '~', self.stream_maxlen, '*', *args)
+            elif op == 'publish_json':
+                pipe.publish(key, sjson.dumps(value))
+            else:
+                getattr(pipe, op)(key, value)
+        try:
+            pipe.execute()
+            self.flushes  += 1
+            self.commands += len(batch)
+        except Exception as E:
+            self.errors += 1
+            self.Log.error('flush(%d commands) failed: %s' % (len(batch), E))
+
+    def run(self):
+        self.Log.debug('run()')
+        done = False
+        while not done:
+            item = self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.time() + self.max_delay
+            while len(batch) < self.max_batch:
+                try:
+                    remaining = deadline - time.time()
+                    if remaining > 0:
+                        item = self.queue.get(True, remaining)
+                    else:
+                        item = self.queue.get_nowait()
+                except Empty:
+                    break
+                if item is None:
+                    done = True
+                    break
+                batch.append(item)
+            self.flush(batch)
+        self.Log.debug('end of run()')
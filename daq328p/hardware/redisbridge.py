@@ -15,14 +15,26 @@ Options:
 
 """
 
+import os
 import time
 import re
+import math
+import random
+import socket
+import itertools
 import simplejson as sjson
 import redis
 
-from datetime import datetime
+from Queue import Queue, Full
+from collections import OrderedDict
 from logbook import Logger
 from docopt import docopt
+from metrics import Metrics, MetricsReporter
+from publisher import BatchPublisher
+from codec import CODECS, codec_of, negotiate
+from futures import Future, TimeoutError
+import tracing
+import transport
 import threading
 
 version = '2013.08.17:2139'
@@ -30,6 +42,7 @@ version = '2013.08.17:2139'
 ##########################################################################################
 class InterfaceTemplate(object):
     last_cmd = ''
+    concurrency = 1     # commands HwRedisInterface may run at the same time
     """docstring for InterfaceTemplate"""
     def __init__(self):
         self.Log = Logger('InterfaceTemplate')
@@ -55,14 +68,61 @@ class InterfaceTemplate(object):
 
 ##########################################################################################
 class HwRedisInterface(threading.Thread):
-
-    def __init__(self, interface=InterfaceTemplate(), channel='', host='127.0.0.1'):
+    '''
+    Runs commands published on channel against interface.
+
+    Messages are queued (at most max_queue) and run by a pool of workers,
+    one unless the interface has a concurrency attribute. The pool size
+    is read once, when the bridge is created: start the listener thread
+    of a Daq328p before bridging it. When the queue is full the sender
+    gets [3, 'busy ...'] instead of a silent drop.
+
+    Read-only commands can be listed in cacheable as {cmd: ttl}: identical
+    queries of them waiting or running at the same time share one call to
+    the interface, and with ttl > 0 the reply is served from a cache for
+    ttl seconds.
+
+    A message with 'batch': [[cmd, kwargs], ...] runs every command in
+    order and is answered once with [0, [[error, data], ...]].
+
+    Messages with a 'trace' get their stages marked (see tracing.py) and
+    the trace returned with the reply; the slowest are written to the
+    key '<channel>_traces'.
+
+    Every reply's out is also published as json on 'res' for monitors,
+    encoded and sent in batches by a BatchPublisher off the reply path.
+
+    Clients in this process can skip redis with LocalClient, clients in
+    other processes on this host with SocketClient when the bridge is
+    given a socket_path (see transport.py).
+    '''
+
+    metrics_interval = 10
+    OVERFLOW         = 3
+    cacheable        = {}       # e.g. {'I': 60, 'A': 0.5}, 0 only merges identical queries
+    cache_size       = 256
+
+    def __init__(self, interface=InterfaceTemplate(), channel='', host='127.0.0.1', workers=None, max_queue=100,
+                 socket_path=None):
         threading.Thread.__init__(self)
         self.timeout   = 1
         self.interface = interface
         self.redis     = redis.Redis(host=host)
         self.msg_count = 0
-        self.busy = 0;
+        self.metrics   = Metrics()
+        self.reporter  = None
+        self.queue     = Queue(max_queue)
+        self.workers   = []
+        self.cache     = ResponseCache(self.cache_size)
+        self.inflight  = {}
+        self.lock      = threading.Lock()
+        self.traces    = tracing.TraceBuffer()
+        self.tracer    = None
+        self.server    = None
+        self.publisher = BatchPublisher(self.redis)
+        if workers is None:
+            workers = getattr(interface, 'concurrency', 1)
+        self.slots     = threading.BoundedSemaphore(max(1, workers))
         if channel=='':
             self.channel   = str(interface)
         else:
@@ -73,6 +133,26 @@ class HwRedisInterface(threading.Thread):
         self.Log.debug('__init__(channel=%s)' % self.channel)
 
         self.pubsub.subscribe(self.channel)
+        # Codecs this bridge decodes, the preferred first, see codec.py
+        self.redis.set('%s_codecs' % self.channel, ','.join(sorted(CODECS, key=lambda name: name == 'json')))
+        self.metrics.gauge('queue', self.queue.qsize)
+        self.metrics.gauge('cache', lambda: len(self.cache))
+        for k in range(max(1, workers)):
+            worker = threading.Thread(target=self.work, name='HwRedisInterface-Worker-%d' % k)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        if self.metrics_interval:
+            # snapshots in the redis key '<channel>_metrics'
+            self.reporter = MetricsReporter(self.metrics, self.redis, '%s_metrics' % self.channel, self.metrics_interval)
+            self.reporter.start()
+            self.tracer = MetricsReporter(self.traces, self.redis, '%s_traces' % self.channel, self.metrics_interval)
+            self.tracer.start()
+        self.publisher.start()
+        transport.register(self.channel, self)
+        if socket_path is not None:
+            self.server = transport.UnixServer(self, socket_path)
+            self.server.start()
         self.start()
         self.setName('HwRedisInterface-Thread')
 
@@ -82,7 +162,14 @@ class HwRedisInterface(threading.Thread):
 
     def stop(self):
         self.Log.info('stop()')
-        self.busy = False
+        transport.unregister(self.channel, self)
+        if self.server is not None:
+            self.server.stop()
+        if self.reporter is not None:
+            self.reporter.stop()
+        if self.tracer is not None:
+            self.tracer.stop()
+        self.publisher.stop()
         self.redis.publish(self.channel,'KILL')
         time.sleep(1)        
         self.Log.info('  stopped')
@@ -92,10 +179,12 @@ class HwRedisInterface(threading.Thread):
         to = time.time()
         try:
             self.interface.send(cmd, kwargs)
+            self.metrics.observe('send', time.time() - to)
             self.Log.debug("    send  = %.3f" % (time.time() - to))
             self.redis.set('%s_send_last' % self.channel, cmd)            
             return True
         except Exception as E:            
+            self.metrics.incr('errors')
             self.Log.error(E.message)
             return False
 
@@ -104,10 +193,12 @@ class HwRedisInterface(threading.Thread):
         to = time.time()
         try:
             out = self.interface.read(**kwargs)            
+            self.metrics.observe('read', time.time() - to)
             self.Log.debug("    interface.read() time = %.3f" % (time.time() - to))
             self.redis.set('%s_read_last' % self.channel, out[1])                
             return out[1]
         except Exception as E:
+            self.metrics.incr('errors')
             self.Log.error(E.message)
             return None
 
@@ -116,10 +207,14 @@ class HwRedisInterface(threading.Thread):
         to = time.time()
         self.Log.debug("    query(%s, %s)" % (cmd, str(kwargs)))
         try:
+            tracing.mark('interface.start')
             out = self.interface.query(cmd, **kwargs)
+            tracing.mark('interface.end')
+            self.metrics.observe('query.%s' % cmd, time.time() - to)
             self.Log.debug("    interface.query() time = %.3f" % (time.time() - to))            
             return out
         except Exception as E:
+            self.metrics.incr('errors')
             self.Log.error(E.message)
             return E
 
@@ -130,56 +225,288 @@ class HwRedisInterface(threading.Thread):
                 self.pubsub.unsubscribe()
                 self.Log.info("unsubscribed and finished")
                 break
-            else:                
-                # self.Log.debug('run() - incoming message')
-                if not self.busy:
-                    self.process_message(item)
+            elif item['type'] == 'message':
+                self.enqueue(item)
+        for worker in self.workers:
+            self.queue.put(None)
         self.Log.debug('end of run()')
 
-    def process_message(self, item):
-        self.Log.debug('process_message(type=%s)' % item['type'])
-        to = time.time()
-        self.busy = True
+    def enqueue(self, item):
+        msg = self.decode(item)
+        if msg is not None:
+            self.accept(msg)
+
+    def accept(self, msg, inline=False):
+        '''
+        Answer a message from the cache, attach it to an identical query
+        already queued or running, or queue it for the workers. Answers
+        it with OVERFLOW when the queue is full. With inline it runs in
+        the calling thread instead of being queued when a worker slot is
+        free, and is queued like any other message otherwise.
+        '''
+        cmd, kwargs, is_query = self.parse(msg)
+        key = self.coalesce_key(cmd, kwargs) if is_query and 'batch' not in msg else None
+        if key is not None:
+            with self.lock:
+                out = self.cache.get(key)
+                if out is None:
+                    waiters = self.inflight.get(key)
+                    if waiters is not None:
+                        if 'trace' in msg:
+                            msg['trace'].mark('bridge.coalesced')
+                        waiters.append(msg)
+                        self.metrics.incr('coalesced')
+                        return
+                    self.inflight[key] = []
+            if out is not None:
+                self.metrics.incr('cache_hits')
+                if 'trace' in msg:
+                    msg['trace'].mark('bridge.cache_hit')
+                self.reply(msg, out)
+                return
+        if inline and self.slots.acquire(False):
+            try:
+                self.handle(time.time(), msg, key, held=True)
+            finally:
+                self.slots.release()
+            return
+        try:
+            self.queue.put_nowait((time.time(), msg, key))
+        except Full:
+            self.metrics.incr('overflow')
+            self.Log.error('enqueue() queue full (%d), rejecting %s' % (self.queue.maxsize, cmd))
+            if is_query:
+                out = [self.OVERFLOW, 'busy: %d commands queued on %s' % (self.queue.maxsize, self.channel)]
+                for waiter in [msg] + self.finish(key, out):
+                    self.reply(waiter, out)
+
+    def work(self):
+        while True:
+            entry = self.queue.get()
+            if entry is None:
+                break
+            self.handle(*entry)
 
-        self.msg_count = self.msg_count + 1
-        if item['type'] == 'message':
+    def handle(self, queued, msg, key, held=False):
+        '''
+        Run msg in a worker slot, held tells the caller already has one
+        '''
+        to = time.time()
+        self.metrics.observe('queue_wait', to - queued)
+        trace = msg.get('trace')
+        if trace is not None:
+            trace.mark('bridge.dequeued', to)
+        previous = tracing.activate(trace)
+        failed = False
+        try:
+            if held:
+                out = self.execute(msg)
+            else:
+                with self.slots:
+                    out = self.execute(msg)
+        except Exception as E:
+            self.metrics.incr('errors')
+            self.Log.error('handle(): %s' % E)
+            out = [1, str(E)]
+            failed = True
+        finally:
+            tracing.activate(previous)
+        # execute() answers msg itself unless it failed
+        waiters = self.finish(key, out)
+        for waiter in ([msg] if failed else []) + waiters:
             try:
-                msg = sjson.loads(item['data'])
-                self.Log.debug('    msg=%s, from=%s' % (msg['cmd'], msg['from']))
-                
-                if isinstance(msg['cmd'],list):
-                    cmd      = msg['cmd'][0]
-                    kwargs   = msg['cmd'][1]
-                    is_query = msg['cmd'][2]
-                else:
-                    cmd      = msg['cmd']                    
-                    is_query = True
-                    
+                self.reply(waiter, out)
             except Exception as E:
-                self.Log.error(E.message)
+                self.metrics.incr('errors')
+                self.Log.error('handle() reply: %s' % E)
+        self.metrics.observe('exec', time.time() - to)
+
+    def coalesce_key(self, cmd, kwargs):
+        '''
+        Identical queries of a command in cacheable share one hardware call
+        '''
+        if cmd not in self.cacheable:
+            return None
+        return '%s %s' % (cmd, sjson.dumps(kwargs, sort_keys=True))
+
+    def finish(self, key, out):
+        '''
+        Cache out when its command has a ttl, returns the coalesced messages
+        waiting for it
+        '''
+        if key is None:
+            return []
+        with self.lock:
+            waiters = self.inflight.pop(key, [])
+            self.store(key, out)
+        return waiters
+
+    def store(self, key, out):
+        '''
+        Cache a successful reply, the caller holds self.lock
+        '''
+        ttl = self.cacheable.get(key.split(' ', 1)[0])
+        if ttl and isinstance(out, (list, tuple)) and out and out[0] == 0:
+            self.cache.put(key, out, ttl)
+
+    def decode(self, item):
+        try:
+            msg = codec_of(item['data']).decode(item['data'])
+            self.Log.debug('    msg=%s, from=%s' % (msg.get('cmd', msg.get('batch')), msg['from']))
+            return self.received(msg)
+        except Exception as E:
+            self.Log.error(E.message)
+            return None
+
+    def received(self, msg):
+        if 'trace' in msg:
+            msg['trace'] = tracing.Trace.from_dict(msg['trace'])
+            msg['trace'].mark('bridge.received')
+        return msg
+
+    def parse(self, msg):
+        '''
+        Returns cmd, kwargs, is_query
+        '''
+        if 'batch' in msg:
+            return 'batch', {}, True
+        if isinstance(msg['cmd'],list):
+            return msg['cmd'][0], msg['cmd'][1], msg['cmd'][2]
+        return msg['cmd'], {}, True
+
+    def reply(self, msg, out):
+        '''
+        Hand the reply to the transport of a local or unix socket client,
+        without touching redis. Otherwise push out to the client's reply
+        list tagged with the request id, in the codec the client asked
+        for, or set the 'from' key for clients that poll for it. One round
+        trip. The replies of every transport are queued for 'res' on the
+        publisher.
+        '''
+        reply = {'id': msg.get('id'), 'out': out}
+        trace = msg.get('trace')
+        if trace is not None:
+            trace.mark('bridge.reply')
+            self.traces.add(trace)
+            reply['trace'] = trace.to_dict()
+        self.publisher.publish_json('res', out)
+        if 'deliver' in msg:
+            msg['deliver'](reply)
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        if 'reply_to' in msg:
+            codec = CODECS.get(msg.get('codec'), CODECS['json'])
+            pipe.rpush(msg['reply_to'], codec.encode(reply))
+            pipe.expire(msg['reply_to'], self.timeout)
+        else:
+            pipe.set(msg['from'], sjson.dumps(out))
+            pipe.expire(msg['from'], self.timeout)
+        pipe.execute()
+
+    def process_message(self, item):
+        self.Log.debug('process_message(type=%s)' % item['type'])
+        if item['type'] == 'message':
+            msg = self.decode(item)
+            if msg is None:
                 return None
-            
-            self.Log.debug('    is_query=%d' % is_query)
-            
-            if is_query:
-                out = self.query(cmd,**kwargs)
-                self.redis.publish('res', sjson.dumps(out))
-                timeout = msg['timeout']
-                timeout = self.timeout
-                self.redis.set(msg['from'],sjson.dumps(out))
-                self.redis.expire(msg['from'], timeout)
-                self.Log.debug('    query(cmd=%s) = %s' % (cmd, str(out)))
-            else:
-                self.Log.debug('    send(cmd)')
-                out = self.interface.send(cmd)
-            self.busy = False
-            return out
+            return self.execute(msg)
         else:
-            self.busy = False
             return None
 
+    def execute(self, msg):
+        '''
+        Run one decoded message, queries are answered to the sender
+        '''
+        to = time.time()
+        self.msg_count = self.msg_count + 1
+        self.metrics.incr('messages')
+        cmd, kwargs, is_query = self.parse(msg)
+
+        self.Log.debug('    is_query=%d' % is_query)
+
+        if 'batch' in msg:
+            out = [0, [self.batch_query(item) for item in msg['batch']]]
+            self.reply(msg, out)
+            self.metrics.observe('message', time.time() - to)
+        elif is_query:
+            out = self.query(cmd,**kwargs)
+            if isinstance(out, Exception):
+                out = [1, str(out)]
+            self.reply(msg, out)
+            self.metrics.observe('message', time.time() - to)
+            self.Log.debug('    query(cmd=%s) = %s' % (cmd, str(out)))
+        else:
+            self.Log.debug('    send(cmd)')
+            out = self.interface.send(cmd)
+        return out
+
+    def batch_query(self, item):
+        '''
+        One command of a batch, [cmd] or [cmd, kwargs]. Errors are returned
+        as [1, message] so they do not fail the rest of the batch.
+        '''
+        key = None
+        try:
+            cmd = item[0]
+            kwargs = item[1] if len(item) > 1 else {}
+            key = self.coalesce_key(cmd, kwargs)
+            if key is not None:
+                with self.lock:
+                    out = self.cache.get(key)
+                if out is not None:
+                    self.metrics.incr('cache_hits')
+                    return out
+            out = self.query(cmd, **kwargs)
+        except Exception as E:
+            out = E
+        if isinstance(out, Exception):
+            return [1, str(out)]
+        if key is not None:
+            with self.lock:
+                self.store(key, out)
+        return out
+
+##########################################################################################
+class ResponseCache(object):
+    '''
+    Replies kept for a time to live, the least recently used go first
+    when more than size are kept
+    '''
+
+    def __init__(self, size=256):
+        self.size    = size
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        expires, value = entry
+        if time.time() >= expires:
+            return None
+        self.entries[key] = entry
+        return value
+
+    def put(self, key, value, ttl):
+        self.entries.pop(key, None)
+        self.entries[key] = (time.time() + ttl, value)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
 ##########################################################################################
 class Client():
+    '''
+    Replies are pushed by HwRedisInterface to the list reply_key and
+    query() waits for them with a blocking pop, matched by request id.
+    Messages use the first codec of codecs the bridge also has. A
+    trace_sample fraction of the queries is traced (see tracing.py),
+    none by default; finished traces are kept in self.traces.
+    '''
+    codecs       = ('msgpack', 'json')
+    trace_sample = 0.0
 
     def __init__(self, channel="test",host='127.0.0.1'):
         self.redis = redis.Redis(host=host)
@@ -187,11 +514,15 @@ class Client():
         self.timeout = 10
         self.query_delay = 0.1
         self.idn = 'Client %d' % id(self)
+        self.reply_key = 'reply:%s:%d:%d' % (socket.gethostname(), os.getpid(), id(self))
+        self.ids = itertools.count(1)
+        self.codec = None
+        self.traces = tracing.TraceBuffer()
         self.Log = Logger('Client')
 
     def __del__(self):
         self.Log.debug('__del__()')
-        self.redis.delete(self.idn)
+        self.redis.delete(self.idn, self.reply_key)
 
     def str(self):
         print self.__unicode__()
@@ -212,33 +543,383 @@ class Client():
             self.redis.delete(self.idn)
         return data_read
 
+    def negotiate(self):
+        '''
+        Pick the codec from what the bridge lists in '<channel>_codecs'
+        '''
+        offered = self.redis.get('%s_codecs' % self.channel)
+        self.codec = negotiate(offered.split(',') if offered else [], self.codecs)
+        self.Log.debug('negotiate() = %s' % self.codec.name)
+        return self.codec
+
+    def encode(self, msg):
+        codec = self.codec or self.negotiate()
+        msg['codec'] = codec.name
+        return codec.encode(msg)
+
+    def publish(self, request, msg):
+        '''
+        Send msg to the bridge, request is expected before it can be answered
+        '''
+        self.start_trace(msg)
+        data = self.encode(msg)
+        self.Log.debug('    full msg=%s)' % data)
+        self.expect(request)
+        self.redis.publish(self.channel, data)
+
+    def start_trace(self, msg):
+        if self.trace_sample and random.random() < self.trace_sample:
+            trace = tracing.Trace()
+            trace.mark('client.send', msg['t'])
+            msg['trace'] = trace.to_dict()
+
+    def finish_trace(self, reply):
+        if 'trace' in reply:
+            trace = tracing.Trace.from_dict(reply['trace'])
+            trace.mark('client.received')
+            self.traces.add(trace)
+
     def send(self, cmd="\n", **kwargs):
+        '''
+        Publish cmd, returns its request id
+        '''
         self.Log.debug('send(cmd=%s)' % cmd)
         timeout = kwargs.pop('timeout',0)
         query   = kwargs.pop('query',1)
+        request = next(self.ids)
 
         try:
             if timeout == 0:
                 timeout = self.timeout
-            msg = sjson.dumps({'from': self.idn, 'cmd': [cmd, kwargs, query], 'timeout': timeout , 'timestamp': str(datetime.now())})
-            self.Log.debug('    full msg=%s)' % msg)
-            self.redis.publish(self.channel, msg)
+            self.publish(request, {'from': self.idn, 'id': request, 'reply_to': self.reply_key,
+                                   'cmd': [cmd, kwargs, query], 'timeout': timeout , 't': time.time()})
+        except Exception as E:
+            self.Log.error(E.message)
+        return request
+
+    def send_batch(self, cmds, **kwargs):
+        '''
+        Publish several commands in one message, returns its request id.
+        cmds are commands or (cmd, kwargs) pairs, kwargs are the defaults.
+        '''
+        self.Log.debug('send_batch(%d commands)' % len(cmds))
+        timeout = kwargs.pop('timeout', 0) or self.timeout
+        request = next(self.ids)
+        batch = []
+        for item in cmds:
+            if isinstance(item, (list, tuple)):
+                batch.append([item[0], dict(kwargs, **item[1])])
+            else:
+                batch.append([item, kwargs])
+        try:
+            self.publish(request, {'from': self.idn, 'id': request, 'reply_to': self.reply_key,
+                                   'batch': batch, 'timeout': timeout, 't': time.time()})
         except Exception as E:
             self.Log.error(E.message)
+        return request
+
+    def expect(self, request):
+        '''
+        Called before request is published
+        '''
+        pass
+
+    def wait_reply(self, request, timeout):
+        '''
+        Pop replies until the one for request arrives, replies to earlier
+        requests that timed out are dropped. Returns the reply
+        {'id', 'out', 'trace'} or None on timeout.
+        '''
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            # blpop takes whole seconds, 0 would block forever
+            item = self.redis.blpop(self.reply_key, max(1, int(math.ceil(remaining))))
+            if item is None:
+                return None
+            try:
+                reply = codec_of(item[1]).decode(item[1])
+            except Exception as E:
+                self.Log.error('wait_reply(): %s' % E)
+                continue
+            if reply.get('id') == request:
+                return reply
+            self.Log.debug('wait_reply() dropping stale reply %s' % reply.get('id'))
 
     def query(self, cmd, **kwargs):
         self.Log.debug('query(cmd=%s, kwargs=%s)' % (cmd, str(kwargs)))
-        self.send(cmd, **kwargs)
-        
-        to = time.time()
-        while time.time() - to < self.timeout and (not self.redis.exists(self.idn)):
-            time.sleep(0.1)
+        timeout = kwargs.get('timeout') or self.timeout
+        reply = self.wait_reply(self.send(cmd, **kwargs), timeout)
+        if reply is None:
+            return [1, None]
+        self.finish_trace(reply)
+        return reply['out']
+
+    def query_many(self, cmds, **kwargs):
+        '''
+        Run cmds in one bridge round trip, returns [[error, data], ...] in
+        the order of cmds. A failed command does not fail the others.
+        '''
+        self.Log.debug('query_many(%d commands)' % len(cmds))
+        timeout = kwargs.get('timeout') or self.timeout
+        reply = self.wait_reply(self.send_batch(cmds, **kwargs), timeout)
+        if reply is not None:
+            self.finish_trace(reply)
+        out = reply and reply['out']
+        if out is None or out[0]:
+            return [[1, out and out[1]] for _ in cmds]
+        return out[1]
 
+##########################################################################################
+class PendingReplies(object):
+    '''
+    Futures of the requests waiting for their reply, by request id
+    '''
+
+    def __init__(self):
+        self.futures = {}
+        self.lock    = threading.Lock()
+
+    def __len__(self):
+        return len(self.futures)
+
+    def expect(self, request):
+        with self.lock:
+            self.futures[request] = Future()
+
+    def resolve(self, reply):
+        '''
+        Hand reply to the request waiting for it, False when none is
+        '''
+        with self.lock:
+            future = self.futures.get(reply.get('id'))
+        if future is None:
+            return False
+        future.set_result(reply)
+        return True
+
+    def wait(self, request, timeout):
+        future = self.futures.get(request)
+        if future is None:
+            return None
         try:
-            return sjson.loads(self.read())
-        except:
-            return [1, self.read()]
+            return future.result(timeout)
+        except TimeoutError:
+            return None
+        finally:
+            with self.lock:
+                self.futures.pop(request, None)
+
+##########################################################################################
+class SharedClient(Client):
+    '''
+    One client for every thread of a process, e.g. the Django views.
+    Commands go out over a small blocking pool of redis connections and a
+    dispatcher thread pops all replies from the one reply list, handing
+    each to the request waiting for it by id. Get the process wide
+    instance with shared_client().
+    '''
+
+    def __init__(self, channel="test", host='127.0.0.1', connections=4):
+        Client.__init__(self, channel, host)
+        self.pool       = redis.BlockingConnectionPool(host=host, max_connections=connections, timeout=self.timeout)
+        self.redis      = redis.Redis(connection_pool=self.pool)
+        self.listener   = redis.Redis(host=host)    # blpop keeps its connection busy
+        self.waiting    = PendingReplies()
+        self.lock       = threading.Lock()
+        self.dispatcher = None
+        self.stopping   = threading.Event()
+        self.Log        = Logger('SharedClient')
+
+    def expect(self, request):
+        self.waiting.expect(request)
+        with self.lock:
+            if self.dispatcher is None:
+                self.dispatcher = threading.Thread(target=self.dispatch, name='SharedClient-Dispatcher')
+                self.dispatcher.daemon = True
+                self.dispatcher.start()
+
+    def wait_reply(self, request, timeout):
+        return self.waiting.wait(request, timeout)
+
+    def dispatch(self):
+        self.Log.debug('dispatch()')
+        while not self.stopping.isSet():
+            try:
+                item = self.listener.blpop(self.reply_key, 1)
+            except Exception as E:
+                self.Log.error('dispatch(): %s' % E)
+                self.stopping.wait(1)
+                continue
+            if item is None:
+                continue
+            try:
+                reply = codec_of(item[1]).decode(item[1])
+            except Exception as E:
+                self.Log.error('dispatch(): %s' % E)
+                continue
+            if not self.waiting.resolve(reply):
+                self.Log.debug('dispatch() dropping stale reply %s' % reply.get('id'))
+        self.Log.debug('end of dispatch()')
+
+    def stop(self):
+        self.stopping.set()
+
+##########################################################################################
+class LocalClient(Client):
+    '''
+    Client of the bridge of channel running in this process. Messages are
+    handed to it as dicts and run in the calling thread while a worker
+    slot is free (queued for the workers otherwise), replies come back
+    through a callback: no redis and no encoding (see transport.py). Safe
+    to share between threads.
+    '''
+
+    def __init__(self, channel="test"):
+        Client.__init__(self, channel)
+        self.redis   = None
+        self.waiting = PendingReplies()
+        self.Log     = Logger('LocalClient')
+
+    def __del__(self):
+        pass
+
+    def expect(self, request):
+        self.waiting.expect(request)
 
+    def wait_reply(self, request, timeout):
+        return self.waiting.wait(request, timeout)
+
+    def publish(self, request, msg):
+        bridge = transport.local_bridge(self.channel)
+        if bridge is None:
+            raise IOError('no bridge of %s in this process' % self.channel)
+        self.start_trace(msg)
+        msg['deliver'] = self.waiting.resolve
+        self.expect(request)
+        bridge.accept(bridge.received(msg), inline=True)
+
+##########################################################################################
+class SocketClient(Client):
+    '''
+    Client of a bridge in another process of this host over its unix
+    socket (see transport.py). Connects on the first command and again
+    after the bridge restarts. A reader thread hands replies to the
+    requests waiting for them, safe to share between threads.
+    '''
+
+    def __init__(self, channel="test", path=None):
+        Client.__init__(self, channel)
+        self.redis   = None
+        self.path    = path or transport.socket_path(channel)
+        self.waiting = PendingReplies()
+        self.lock    = threading.Lock()
+        self.sock    = None
+        self.Log     = Logger('SocketClient')
+
+    def __del__(self):
+        self.close()
+
+    def connect(self):
+        '''
+        Connect and pick the codec from the ones the bridge sends first,
+        the caller holds self.lock
+        '''
+        self.Log.debug('connect(%s)' % self.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        offered = transport.recv_frame(sock)
+        if offered is None:
+            sock.close()
+            raise IOError('%s closed the connection' % self.path)
+        self.codec = negotiate(sjson.loads(offered), self.codecs)
+        self.sock  = sock
+        reader = threading.Thread(target=self.dispatch, args=(sock,), name='SocketClient-Reader')
+        reader.daemon = True
+        reader.start()
+
+    def close(self):
+        with self.lock:
+            sock, self.sock = self.sock, None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            sock.close()
+
+    def expect(self, request):
+        self.waiting.expect(request)
+
+    def wait_reply(self, request, timeout):
+        return self.waiting.wait(request, timeout)
+
+    def publish(self, request, msg):
+        self.start_trace(msg)
+        with self.lock:
+            if self.sock is None:
+                self.connect()
+            data = self.encode(msg)
+            self.expect(request)
+            try:
+                transport.send_frame(self.sock, data)
+            except socket.error:
+                self.sock.close()
+                self.sock = None
+                raise
+
+    def dispatch(self, sock):
+        self.Log.debug('dispatch()')
+        try:
+            while True:
+                data = transport.recv_frame(sock)
+                if data is None:
+                    break
+                reply = codec_of(data).decode(data)
+                if not self.waiting.resolve(reply):
+                    self.Log.debug('dispatch() dropping stale reply %s' % reply.get('id'))
+        except Exception as E:
+            self.Log.error('dispatch(): %s' % E)
+        with self.lock:
+            if self.sock is sock:
+                self.sock = None
+        sock.close()
+        self.Log.debug('end of dispatch()')
+
+def connect(channel="test", host='127.0.0.1', kind='redis'):
+    '''
+    A client of channel: a Client over redis on host, or with kind
+    'local', 'unix', 'unix:PATH' or 'auto' one that skips redis, see
+    transport.py
+    '''
+    using, path = transport.resolve(kind, channel)
+    if using == 'local':
+        return LocalClient(channel)
+    if using == 'unix':
+        return SocketClient(channel, path)
+    return Client(channel, host)
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+def shared_client(channel="test", host='127.0.0.1', kind='redis'):
+    '''
+    The process wide client of channel, a new one after a fork. Over redis
+    it is a SharedClient of host, otherwise see connect().
+    '''
+    using, path = transport.resolve(kind, channel)
+    key = (channel, host, using, path, os.getpid())
+    with _shared_lock:
+        client = _shared.get(key)
+        if client is None:
+            if using == 'redis':
+                client = SharedClient(channel, host)
+            else:
+                client = connect(channel, host, kind)
+            _shared[key] = client
+    return client
 
 
 if __name__ == "__main__":
@@ -0,0 +1,82 @@
+"""replay.py -
+
+Replay raw serial captures (capture.py) through the parser and publisher
+at the recorded speed, N times faster or as fast as possible.
+
+Usage:
+  replay.py FILE [--speed=SPEED] [--redis=HOST] [--binary]
+  replay.py dump FILE
+  replay.py (-h | --help)
+
+Options:
+  -h, --help
+  --speed=SPEED     replay speed, 1 is real time, 0 is as fast as possible [default: 0]
+
+"""
+
+import time
+
+from docopt import docopt
+from redis import Redis
+
+from daq328p import Daq328pBase
+from framing import FrameParser
+from publisher import BatchPublisher
+from capture import read_capture
+from clock import time_ns
+
+##########################################################################################
+class ReplayBoard(Daq328pBase):
+    '''
+    A Daq328p without a serial port: parses and publishes what it is fed
+    '''
+
+    def __init__(self, redis=None, namespace='', binary=False):
+        self.redis     = redis if redis is not None else Redis()
+        self.namespace = namespace
+        self.parser    = FrameParser(binary=binary)
+        self.init_storage()
+        self.publisher = BatchPublisher(self.redis, self.publish_batch, self.publish_delay)
+        self.publisher.start()
+        self.init_metrics()
+
+    def handle_data(self, data, t=None):
+        self.metrics.incr('bytes_in', len(data))
+        self.process_chunk(data, t if t is not None else time_ns())
+
+    def close(self):
+        self.publisher.stop()
+
+def replay(path, board, speed=0):
+    '''
+    Feed a capture to board.handle_data() with the recorded read times.
+    speed=1 keeps the recorded timing, speed=N plays N times faster,
+    speed=0 does not wait at all.
+    Returns (chunks, bytes).
+    '''
+    chunks = nbytes = 0
+    start = first = None
+    for t, data in read_capture(path):
+        if speed > 0:
+            if first is None:
+                first, start = t, time.time()
+            delay = (t - first) / 1e9 / speed - (time.time() - start)
+            if delay > 0:
+                time.sleep(delay)
+        board.handle_data(data, t)
+        chunks += 1
+        nbytes += len(data)
+    return chunks, nbytes
+
+if __name__ == '__main__':
+    opt = docopt(__doc__)
+    if opt['dump']:
+        for t, data in read_capture(opt['FILE']):
+            print '%.6f %r' % (t / 1e9, data)
+    else:
+        board = ReplayBoard(Redis(host=opt['--redis']) if opt['--redis'] else None, binary=opt['--binary'])
+        to = time.time()
+        chunks, nbytes = replay(opt['FILE'], board, float(opt['--speed']))
+        board.close()
+        dt = time.time() - to
+        print "%d chunks, %d bytes, %d frames in %.3f s (%.2f MB/s)" % (chunks, nbytes, board.parser.frames, dt, nbytes / dt / 1e6)
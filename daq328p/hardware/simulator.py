@@ -0,0 +1,180 @@
+"""simulator.py -
+
+Software stand-in for the Daq328p firmware on a pseudo terminal.
+
+The simulator owns the master side of a pty and answers commands written
+to the slave side, which Daq328p opens like a real serial port. It can
+stream <json> (or binary) sample frames at a configurable rate, in bursts,
+with a fraction of malformed frames.
+
+    sim = FirmwareSimulator(rate=100, sensors=4)
+    sim.start()
+    D = Daq328p(port=sim.port)
+
+Commands:
+  I       identification, ends with the cmd> prompt
+  A       one sample frame of all sensors
+  B1, B0  binary sample frames on / off, answers <mode>bin|txt</mode>
+  R<n>    stream n sample frames per second, R0 stops streaming
+
+Usage:
+  simulator.py [--rate=RATE] [--sensors=N] [--burst=N] [--malformed=P] [--binary]
+  simulator.py (-h | --help)
+
+Options:
+  -h, --help
+  --rate=RATE       [default: 1]
+  --sensors=N       [default: 4]
+  --burst=N         [default: 1]
+  --malformed=P     [default: 0]
+
+"""
+
+import os
+import random
+import select
+import time
+import serial
+import simplejson as sjson
+
+from threading import Thread, Event
+from logbook import Logger
+from docopt import docopt
+
+from framing import pack_samples
+from clock import monotonic
+
+IDN = 'Daq328p simulator 2013.12.15'
+PROMPT = 'cmd>'
+
+def wait_ready(port, timeout=5):
+    '''
+    Wait until the simulator on port answers 'I', e.g. one started in a
+    child process, before a driver sends its first query to it
+    '''
+    s = serial.Serial(port, 115200, timeout=0.1)
+    try:
+        deadline = monotonic() + timeout
+        data = ''
+        s.write('I\n')
+        while PROMPT not in data and monotonic() < deadline:
+            data += s.read(4096)
+    finally:
+        s.close()
+    return PROMPT in data
+
+##########################################################################################
+class FirmwareSimulator(Thread):
+
+    def __init__(self, rate=0, sensors=4, burst=1, malformed=0.0, binary=False, reply_delay=0.0, seed=None):
+        Thread.__init__(self)
+        self.setName('FirmwareSimulator-Thread')
+        self.daemon      = True
+        self.rate        = rate
+        self.sensors     = ['28ff6a4b%08x' % k for k in range(sensors)]
+        self.burst       = burst
+        self.malformed   = malformed
+        self.binary      = binary
+        self.reply_delay = reply_delay
+        self.random      = random.Random(seed)
+        self.master, slave = os.openpty()
+        self.port        = os.ttyname(slave)
+        self._slave      = slave
+        self.running     = Event()
+        self.frames_sent = 0
+        self.bytes_sent  = 0
+        self.bad_sent    = 0
+        self.commands    = 0
+        self.sent_at     = []
+        self.Log         = Logger('FirmwareSimulator')
+
+    def stop(self):
+        self.running.clear()
+        if self.is_alive():
+            self.join(2)
+        os.close(self.master)
+        os.close(self._slave)
+
+    def write(self, data):
+        view = memoryview(data)
+        while len(view):
+            n = os.write(self.master, view)
+            view = view[n:]
+        self.bytes_sent += len(data)
+
+    def sample_frame(self):
+        '''
+        One frame of all sensors. The first value is the frame sequence
+        number so a benchmark can match it to sent_at.
+        '''
+        seq = self.frames_sent
+        self.frames_sent += 1
+        self.sent_at.append(time.time())
+        values = [seq] + [round(20 + 5 * self.random.random(), 2) for k in self.sensors[1:]]
+        if self.malformed and self.random.random() < self.malformed:
+            self.bad_sent += 1
+            return '<json>[["%s", %d], ["%s"</json>\r\n' % (self.sensors[0], seq, self.sensors[-1])
+        if self.binary:
+            return pack_samples(zip(self.sensors, values))
+        return '<json>%s</json>\r\n' % sjson.dumps([[sn, v] for sn, v in zip(self.sensors, values)])
+
+    def answer(self, cmd):
+        self.commands += 1
+        if self.reply_delay:
+            time.sleep(self.reply_delay)
+        if cmd == 'I':
+            return '%s\r\n%s' % (IDN, PROMPT)
+        if cmd == 'A':
+            return self.sample_frame()
+        if cmd in ('B1', 'B0'):
+            self.binary = cmd == 'B1'
+            return '<mode>%s</mode>\r\n' % ('bin' if self.binary else 'txt')
+        if cmd.startswith('R'):
+            try:
+                self.rate = float(cmd[1:])
+                return 'rate %s\r\n' % self.rate
+            except ValueError:
+                pass
+        return 'unknown command: %s\r\n' % cmd
+
+    def run(self):
+        self.running.set()
+        buff = ''
+        next_frame = monotonic()
+        while self.running.isSet():
+            if self.rate > 0:
+                timeout = max(0, next_frame - monotonic())
+            else:
+                timeout = 0.1
+            ready = select.select([self.master], [], [], timeout)[0]
+            if ready:
+                try:
+                    buff += os.read(self.master, 4096)
+                except OSError:
+                    break
+                while '\n' in buff:
+                    line, buff = buff.split('\n', 1)
+                    line = line.strip()
+                    if line:
+                        self.write(self.answer(line))
+            if self.rate > 0 and monotonic() >= next_frame:
+                self.write(''.join(self.sample_frame() for k in range(self.burst)))
+                next_frame += float(self.burst) / self.rate
+                if next_frame < monotonic() - 1:
+                    # Fell behind by more than a second, do not try to catch up
+                    next_frame = monotonic()
+            elif self.rate <= 0:
+                next_frame = monotonic()
+
+if __name__ == '__main__':
+    opt = docopt(__doc__)
+    sim = FirmwareSimulator(rate=float(opt['--rate']), sensors=int(opt['--sensors']), burst=int(opt['--burst']),
+                            malformed=float(opt['--malformed']), binary=opt['--binary'])
+    print "Daq328p simulator on %s" % sim.port
+    sim.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    sim.stop()
@@ -0,0 +1,174 @@
+"""spool.py -
+
+Durable store-and-forward spool for sensor readings.
+
+Readings are appended as json lines to numbered segment files, which is
+plain sequential I/O. A reader takes batches from the replay position and
+acknowledges them once they are delivered; the position is kept in a file
+so delivery resumes where it stopped after a restart. Fully delivered
+segments are deleted and, when the spool grows past max_bytes, the oldest
+segments are evicted even if they were not delivered. Batches the
+receiver rejects for good are moved to the dead letter file.
+
+    spool/00000001.seg
+    spool/00000002.seg
+    spool/position        "<segment> <offset>"
+    spool/rejected        dead letters, json lines
+"""
+
+import os
+import simplejson as sjson
+
+from threading import Lock
+from logbook import Logger
+
+##########################################################################################
+class Spool(object):
+
+    def __init__(self, path, segment_size=4 * 2**20, max_bytes=256 * 2**20, fsync=False):
+        self.path         = path
+        self.segment_size = segment_size
+        self.max_bytes    = max_bytes
+        self.fsync        = fsync
+        self.lock         = Lock()
+        self.evicted      = 0
+        self.rejected     = 0
+        self.Log          = Logger('Spool')
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        segments = self.segments()
+        self.position = self.load_position(segments)
+        # Never append after a record that may have been torn by a crash
+        self.segment = (segments[-1] + 1) if segments else 1
+        self.writer  = open(self.segment_name(self.segment), 'ab')
+        self.written = 0
+
+    def __len__(self):
+        '''
+        Bytes waiting to be delivered
+        '''
+        with self.lock:
+            return self.pending_bytes()
+
+    def segment_name(self, segment):
+        return os.path.join(self.path, '%08d.seg' % segment)
+
+    def segments(self):
+        return sorted(int(name[:-4]) for name in os.listdir(self.path) if name.endswith('.seg'))
+
+    def load_position(self, segments):
+        try:
+            with open(os.path.join(self.path, 'position')) as f:
+                segment, offset = [int(x) for x in f.read().split()]
+        except (IOError, ValueError):
+            segment, offset = 0, 0
+        if segments and segment < segments[0]:
+            segment, offset = segments[0], 0
+        return (segment, offset)
+
+    def save_position(self):
+        tmp = os.path.join(self.path, 'position.tmp')
+        with open(tmp, 'w') as f:
+            f.write('%d %d' % self.position)
+        os.rename(tmp, os.path.join(self.path, 'position'))
+
+    def pending_bytes(self):
+        total = 0
+        for segment in self.segments():
+            if segment >= self.position[0]:
+                total += os.path.getsize(self.segment_name(segment))
+        return total - self.position[1]
+
+    def append(self, record):
+        self.append_many([record])
+
+    def append_many(self, records):
+        if not records:
+            return
+        data = ''.join(sjson.dumps(record) + '\n' for record in records)
+        with self.lock:
+            self.writer.write(data)
+            self.writer.flush()
+            if self.fsync:
+                os.fsync(self.writer.fileno())
+            self.written += len(data)
+            if self.written >= self.segment_size:
+                self.roll()
+
+    def roll(self):
+        self.writer.close()
+        self.segment += 1
+        self.writer  = open(self.segment_name(self.segment), 'ab')
+        self.written = 0
+        self.evict()
+
+    def evict(self):
+        segments = self.segments()
+        total = sum(os.path.getsize(self.segment_name(s)) for s in segments)
+        while total > self.max_bytes and len(segments) > 1:
+            oldest = segments.pop(0)
+            name = self.segment_name(oldest)
+            size = os.path.getsize(name)
+            os.remove(name)
+            total -= size
+            if oldest >= self.position[0]:
+                self.evicted += size - (self.position[1] if oldest == self.position[0] else 0)
+                self.Log.error('evict() dropped undelivered segment %d' % oldest)
+                self.position = (segments[0], 0)
+                self.save_position()
+
+    def read_batch(self, max_records=500):
+        '''
+        Returns (records, position) starting at the replay position. Pass
+        position to ack() once the records are delivered.
+        '''
+        records = []
+        with self.lock:
+            segment, offset = self.position
+            segments = [s for s in self.segments() if s >= segment]
+            for s in segments:
+                if s != segment:
+                    segment, offset = s, 0
+                with open(self.segment_name(s), 'rb') as f:
+                    f.seek(offset)
+                    while len(records) < max_records:
+                        line = f.readline()
+                        if not line.endswith('\n'):
+                            break
+                        offset += len(line)
+                        try:
+                            records.append(sjson.loads(line))
+                        except ValueError:
+                            self.Log.error('read_batch() skipping corrupt record in segment %d' % s)
+                if len(records) >= max_records:
+                    break
+        return records, (segment, offset)
+
+    def ack(self, position):
+        '''
+        Move the replay position and delete fully delivered segments
+        '''
+        with self.lock:
+            if position <= self.position:
+                return
+            self.position = position
+            self.save_position()
+            for s in self.segments():
+                if s < position[0] and s != self.segment:
+                    os.remove(self.segment_name(s))
+
+    def reject(self, records):
+        '''
+        Keep records the receiver will never accept in the dead letter
+        file, the caller still ack()s past them
+        '''
+        data = ''.join(sjson.dumps(record) + '\n' for record in records)
+        with self.lock:
+            with open(os.path.join(self.path, 'rejected'), 'ab') as f:
+                f.write(data)
+            self.rejected += len(records)
+
+    def close(self):
+        with self.lock:
+            self.writer.close()
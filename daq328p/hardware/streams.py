@@ -0,0 +1,162 @@
+"""streams.py -
+
+Readers of the redis streams written by Daq328p with stream_output.
+
+PUBLISH is lost on consumers that are slow or restarting; a stream keeps
+the last stream_maxlen entries (see BatchPublisher.xadd) and every reader
+keeps its own position. StreamConsumer reads in batches through a consumer
+group and acknowledges what it handled, so after a restart it first gets
+back the entries it was given but did not acknowledge. StreamReader reads
+without a group from a last id the caller keeps.
+
+Entries are {'t': time_ns, 'msg': '[timestamp text, data, t]'}, the same
+message that is published on the channel.
+
+    C = StreamConsumer(Redis(), 'irq:stream', 'uploader', 'pi-1')
+    while True:
+        for entry_id, fields in C.read():
+            timestamp, rows, t = decode(fields)
+        C.ack()
+
+Usage:
+  streams.py tail STREAM [--group=GROUP] [--consumer=NAME] [--redis=HOST]
+  streams.py upload STREAM [--submit_to=HOST] [--group=GROUP] [--consumer=NAME] [--redis=HOST]
+  streams.py (-h | --help)
+
+Options:
+  -h, --help
+  --consumer=NAME     [default: consumer-1]
+  --redis=HOST        [default: 127.0.0.1]
+  --submit_to=HOST    [default: sensoredweb.heroku.com]
+
+"""
+
+from logbook import Logger
+from docopt import docopt
+from redis import Redis
+from redis.exceptions import ResponseError
+
+import codec
+
+def fields_dict(flat):
+    '''
+    [field, value, field, value, ...] as returned by redis to a dict
+    '''
+    return dict(zip(flat[::2], flat[1::2]))
+
+def decode(fields):
+    '''
+    Returns [timestamp text, data, t] of a stream entry, in any codec
+    '''
+    return codec.decode(fields['msg'])
+
+##########################################################################################
+class StreamConsumer(object):
+    '''
+    One consumer of a consumer group. The group is created at the start of
+    the stream (start='0') or at its end (start='$') if it does not exist.
+    '''
+
+    def __init__(self, redis, stream, group, consumer, count=100, block=1000, start='0'):
+        self.redis      = redis
+        self.stream     = stream
+        self.group      = group
+        self.consumer   = consumer
+        self.count      = count
+        self.block      = block
+        self.recovering = True
+        self.unacked    = []
+        self.Log        = Logger('StreamConsumer')
+        self.create_group(start)
+
+    def create_group(self, start='0'):
+        try:
+            self.redis.execute_command('XGROUP', 'CREATE', self.stream, self.group, start, 'MKSTREAM')
+        except ResponseError as E:
+            if 'BUSYGROUP' not in str(E):
+                raise
+
+    def xreadgroup(self, last_id, block=None):
+        args = ['XREADGROUP', 'GROUP', self.group, self.consumer, 'COUNT', self.count]
+        if block is not None:
+            args += ['BLOCK', block]
+        reply = self.redis.execute_command(*(args + ['STREAMS', self.stream, last_id]))
+        if not reply:
+            return []
+        return reply[0][1]
+
+    def read(self):
+        '''
+        Returns the next batch [(id, fields)], waiting up to block ms for
+        it. Entries delivered before but not acknowledged come first.
+        '''
+        if self.recovering:
+            entries = self.xreadgroup('0')
+            if not entries:
+                self.recovering = False
+                self.Log.debug('read() caught up on pending entries of %s' % self.consumer)
+        if not self.recovering:
+            entries = self.xreadgroup('>', self.block)
+        batch = []
+        for entry_id, flat in entries:
+            self.unacked.append(entry_id)
+            # Pending entries trimmed from the stream come back without fields
+            if flat is not None:
+                batch.append((entry_id, fields_dict(flat)))
+        return batch
+
+    def ack(self):
+        '''
+        Acknowledge everything returned by read() so far
+        '''
+        unacked, self.unacked = self.unacked, []
+        if not unacked:
+            return 0
+        return self.redis.execute_command('XACK', self.stream, self.group, *unacked)
+
+##########################################################################################
+class StreamReader(object):
+    '''
+    Reads a stream after last_id without a consumer group, the caller
+    saves last_id to resume from it
+    '''
+
+    def __init__(self, redis, stream, last_id='0', count=100, block=1000):
+        self.redis   = redis
+        self.stream  = stream
+        self.last_id = last_id
+        self.count   = count
+        self.block   = block
+
+    def read(self):
+        reply = self.redis.execute_command('XREAD', 'COUNT', self.count, 'BLOCK', self.block,
+                                           'STREAMS', self.stream, self.last_id)
+        if not reply:
+            return []
+        batch = [(entry_id, fields_dict(flat)) for entry_id, flat in reply[0][1]]
+        if batch:
+            self.last_id = batch[-1][0]
+        return batch
+
+if __name__ == '__main__':
+    opt = docopt(__doc__)
+    group = opt['--group'] or ('upload' if opt['upload'] else 'tail')
+    C = StreamConsumer(Redis(host=opt['--redis']), opt['STREAM'], group, opt['--consumer'])
+    submitter = None
+    if opt['upload']:
+        from submit import Submitter
+        submitter = Submitter(opt['--submit_to'])
+        submitter.start()
+    try:
+        while True:
+            for entry_id, fields in C.read():
+                timestamp, data, t = decode(fields)
+                if submitter is not None:
+                    submitter.submit_many(data, t)
+                else:
+                    print entry_id, timestamp, data
+            C.ack()
+    except KeyboardInterrupt:
+        pass
+    if submitter is not None:
+        submitter.stop()
@@ -0,0 +1,378 @@
+"""submit.py -
+
+Background submission of sensor readings to the sensordata web service.
+
+Readings are put on a bounded queue and a worker thread posts them in
+batches over one keep-alive requests.Session. Failed batches are retried
+with exponential backoff, batches rejected with a 4xx are not retried.
+Without the server's bulk route readings are sent one by one, and a
+failed batch is retried from the reading that failed.
+
+With a Spool every reading is written to disk first and the worker
+drains the spool in bulk, so nothing is lost while the web service is
+down; rejected batches go to the spool's dead letter file.
+
+StubServer is a local stand-in for the web service so batching can be
+tested and benchmarked offline.
+
+Usage:
+  submit.py stub [--port=PORT]
+  submit.py (-h | --help)
+
+Options:
+  -h, --help
+  --port=PORT   [default: 8000]
+
+"""
+
+import time
+import simplejson as sjson
+import requests
+
+from threading import Thread, Event
+from Queue import Queue, Empty, Full
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from logbook import Logger
+from docopt import docopt
+
+from clock import time_ns, format_ns
+
+SINGLE_URL = 'http://%s:%d/sensordata/api/submit/datavalue/now/sn/%s/val/%s'
+BULK_URL   = 'http://%s:%d/sensordata/api/submit/datavalues/'
+
+def rejected(error):
+    '''
+    True when error is a 4xx answer that a retry would get again
+    '''
+    response = getattr(error, 'response', None)
+    status = getattr(response, 'status_code', None)
+    return (isinstance(error, requests.HTTPError) and status is not None
+            and 400 <= status < 500 and status not in (408, 429))
+
+##########################################################################################
+class PartialPost(Exception):
+    '''
+    A post that failed at batch[sent], the readings before it went
+    through except refused, the ones the server rejected
+    '''
+
+    def __init__(self, sent, refused, error):
+        Exception.__init__(self, 'failed at reading %d: %s' % (sent, error))
+        self.sent    = sent
+        self.refused = refused
+        self.error   = error
+
+def wire_rows(batch):
+    '''
+    [[sn, value, t], ...] as posted: [[sn, value, timestamp text, t], ...]
+    with t in ns since the epoch (None for text times from old spools)
+    '''
+    return [[sn, value, format_ns(t), t if isinstance(t, (int, long)) else None] for sn, value, t in batch]
+
+##########################################################################################
+class Submitter(Thread):
+    '''
+    S = Submitter('192.168.1.133')
+    S.start()
+    S.submit_many([[sn, value], ...])
+
+    Every reading is sent with the one-GET-per-value url over the pooled
+    session. bulk=True posts whole batches to BULK_URL instead, only for
+    servers that have that route: a 404 from it switches back to GETs.
+    With spool=Spool(...) readings are spooled and retried until delivered
+    instead of dropped after retries.
+    '''
+
+    def __init__(self, submit_to='sensoredweb.heroku.com', port=8000, bulk=False,
+                 batch_size=200, max_delay=1.0, max_queue=10000,
+                 retries=5, backoff=0.5, max_backoff=30, timeout=10, spool=None):
+        Thread.__init__(self)
+        self.setName('Submitter-Thread')
+        self.daemon      = True
+        self.submit_to   = submit_to
+        self.port        = port
+        self.bulk        = bulk
+        self.batch_size  = batch_size
+        self.max_delay   = max_delay
+        self.retries     = retries
+        self.backoff     = backoff
+        self.max_backoff = max_backoff
+        self.timeout     = timeout
+        self.queue       = Queue(max_queue)
+        self.session     = requests.Session()
+        self.spool       = spool
+        self.wakeup      = Event()
+        self.stopping    = Event()
+        self.submitted   = 0
+        self.dropped     = 0
+        self.rejected    = 0
+        self.failures    = 0
+        self.Log         = Logger('Submitter')
+
+    def submit(self, sn, value, timestamp=None):
+        '''
+        Queue one reading, returns False when the queue is full.
+        timestamp is a clock.time_ns(), default now.
+        '''
+        if timestamp is None:
+            timestamp = time_ns()
+        if self.spool is not None:
+            self.spool.append([sn, value, timestamp])
+            self.wakeup.set()
+            return True
+        try:
+            self.queue.put_nowait([sn, value, timestamp])
+            return True
+        except Full:
+            self.dropped += 1
+            self.Log.error('submit() queue full, dropping %s=%s' % (sn, value))
+            return False
+
+    def submit_many(self, rows, timestamp=None):
+        '''
+        Queue [[sn, ..., value], ...] as sent by the firmware in <json> frames
+        '''
+        if timestamp is None:
+            timestamp = time_ns()
+        if self.spool is not None:
+            self.spool.append_many([[row[0], row[-1], timestamp] for row in rows])
+            self.wakeup.set()
+            return True
+        return all([self.submit(row[0], row[-1], timestamp) for row in rows])
+
+    def stop(self, timeout=5):
+        '''
+        Post whatever is queued and stop the thread
+        '''
+        self.stopping.set()
+        self.wakeup.set()
+        try:
+            self.queue.put_nowait(None)
+        except Full:
+            # run() sees stopping once it has emptied the queue
+            pass
+        if self.is_alive():
+            self.join(timeout)
+
+    def post(self, batch):
+        '''
+        Send one batch, returns the readings the server rejected (4xx to
+        their GET), raises on failure or when the whole batch is rejected.
+        Readings sent one by one raise PartialPost, so a retry can start
+        at the reading that failed.
+        '''
+        if self.bulk:
+            res = self.session.post(BULK_URL % (self.submit_to, self.port),
+                                    data=sjson.dumps({'data': wire_rows(batch)}),
+                                    headers={'Content-Type': 'application/json'},
+                                    timeout=self.timeout)
+            if res.status_code == 404:
+                self.Log.error('post() %s has no bulk route, sending readings one by one' % self.submit_to)
+                self.bulk = False
+            else:
+                res.raise_for_status()
+                return []
+        refused = []
+        for k, reading in enumerate(batch):
+            sn, value = reading[0], reading[1]
+            try:
+                res = self.session.get(SINGLE_URL % (self.submit_to, self.port, sn, value), timeout=self.timeout)
+                res.raise_for_status()
+            except Exception as E:
+                if not rejected(E):
+                    raise PartialPost(k, refused, E)
+                self.Log.error('post() %s=%s rejected: %s' % (sn, value, E))
+                refused.append(reading)
+        return refused
+
+    def post_with_retry(self, batch):
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                self.count(batch, self.post(batch))
+                return True
+            except Exception as E:
+                self.failures += 1
+                self.Log.error('post(%d readings) attempt %d failed: %s' % (len(batch), attempt + 1, E))
+                if rejected(E):
+                    self.rejected += len(batch)
+                    break
+                if isinstance(E, PartialPost):
+                    # Retry from the reading that failed, the server has the others
+                    self.count(batch[:E.sent], E.refused)
+                    batch = batch[E.sent:]
+                if attempt < self.retries:
+                    time.sleep(delay)
+                    delay = min(self.max_backoff, delay * 2)
+        self.dropped += len(batch)
+        return False
+
+    def count(self, posted, refused):
+        self.rejected  += len(refused)
+        self.dropped   += len(refused)
+        self.submitted += len(posted) - len(refused)
+
+    def drain(self):
+        '''
+        Post spooled readings until the spool is empty, returns False when
+        a post fails and should be retried. Rejected batches are moved to
+        the dead letter file so they do not block the spool, and the part
+        of a batch delivered before a failure is acked so it is not sent
+        again.
+        '''
+        while True:
+            records, position = self.spool.read_batch(self.batch_size)
+            if not records:
+                return True
+            try:
+                refused = self.post(records)
+            except PartialPost as E:
+                self.failures += 1
+                self.Log.error('drain(%d readings) failed: %s' % (len(records), E))
+                if E.sent:
+                    self.settle(records[:E.sent], E.refused, self.spool.read_batch(E.sent)[1])
+                return False
+            except Exception as E:
+                if not rejected(E):
+                    self.failures += 1
+                    self.Log.error('drain(%d readings) failed: %s' % (len(records), E))
+                    return False
+                self.Log.error('drain(%d readings) rejected: %s' % (len(records), E))
+                refused = records
+            self.settle(records, refused, position)
+
+    def settle(self, records, refused, position):
+        '''
+        Dead-letter refused and ack the spool up to position, the end of records
+        '''
+        if refused:
+            self.rejected += len(refused)
+            self.spool.reject(refused)
+        self.spool.ack(position)
+        self.submitted += len(records) - len(refused)
+
+    def run_spool(self):
+        delay = self.backoff
+        self.wakeup.set()
+        while not self.stopping.isSet():
+            self.wakeup.wait()
+            # Let a batch build up before draining
+            self.stopping.wait(self.max_delay)
+            self.wakeup.clear()
+            if self.drain():
+                delay = self.backoff
+            else:
+                self.stopping.wait(delay)
+                delay = min(self.max_backoff, delay * 2)
+                self.wakeup.set()
+        self.drain()
+
+    def run(self):
+        self.Log.debug('run()')
+        if self.spool is not None:
+            self.run_spool()
+            self.Log.debug('end of run()')
+            return
+        done = False
+        while not done:
+            if self.stopping.isSet():
+                try:
+                    item = self.queue.get_nowait()
+                except Empty:
+                    break
+            else:
+                item = self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.time() + self.max_delay
+            while len(batch) < self.batch_size:
+                try:
+                    remaining = deadline - time.time()
+                    if remaining > 0:
+                        item = self.queue.get(True, remaining)
+                    else:
+                        item = self.queue.get_nowait()
+                except Empty:
+                    break
+                if item is None:
+                    done = True
+                    break
+                batch.append(item)
+            self.post_with_retry(batch)
+        self.Log.debug('end of run()')
+
+##########################################################################################
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    wbufsize = -1
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, code, body):
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def fail(self):
+        server = self.server
+        if server.fail > 0:
+            server.fail -= 1
+            self.reply(503, '"unavailable"')
+            return True
+        return False
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        if not self.fail():
+            if len(parts) == 9 and parts[-4] == 'sn':
+                self.server.record([[parts[-3], parts[-1], None]])
+                self.reply(200, '"ok"')
+            else:
+                self.reply(404, '"not found"')
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+        if not self.fail():
+            data = sjson.loads(body)['data']
+            self.server.record(data)
+            self.reply(200, sjson.dumps({'received': len(data)}))
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    '''
+    Local stand-in for the sensordata api, counts what it receives.
+    Set fail=N to answer the next N requests with 503.
+    '''
+    daemon_threads = True
+
+    def __init__(self, port=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), StubHandler)
+        self.port     = self.server_address[1]
+        self.readings = []
+        self.requests = 0
+        self.fail     = 0
+
+    def record(self, rows):
+        self.requests += 1
+        self.readings.extend(rows)
+
+    def start(self):
+        thread = Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+if __name__ == '__main__':
+    opt = docopt(__doc__)
+    if opt['stub']:
+        server = StubServer(int(opt['--port']))
+        print "stub sensordata api on port %d" % server.port
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
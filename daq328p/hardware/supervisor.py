@@ -0,0 +1,218 @@
+"""supervisor.py -
+
+Run HwRedisInterface bridges in worker processes, one per device group.
+
+Every worker process owns the interfaces and bridges of the channels
+routed to it, so json decoding, logging and redis traffic of different
+devices run on different cores instead of sharing one GIL. The
+supervisor restarts workers that die (backing off when they keep
+crashing), keeps the routing table in the redis key 'bridge:routes' and
+every worker reports its load in 'bridge:worker:<name>'. Every bridge
+also serves clients on this host on the unix socket
+transport.socket_path(channel), see transport.py.
+
+A route is [channel, 'module:factory', {kwargs}]; the factory is called
+in the worker to build the interface. Interfaces with a start_thread()
+method (Daq328p) get their listener thread started.
+
+    S = BridgeSupervisor({'daq'    : [['test', 'daq328p:Daq328p', {'port': '/dev/ttyUSB0'}]],
+                          'insteon': [['insteon', 'insteon_cli:InsteonCli', {}]]})
+    S.start()
+    S.report()
+
+Usage:
+  supervisor.py CONFIG [--redis=HOST]
+  supervisor.py (-h | --help)
+
+CONFIG is a json file {"worker name": [[channel, "module:factory", {kwargs}], ...], ...}
+
+Options:
+  -h, --help
+  --redis=HOST        [default: 127.0.0.1]
+
+"""
+
+import os
+import signal
+import time
+import importlib
+import multiprocessing
+import simplejson as sjson
+import redis
+
+from threading import Thread, Event
+from logbook import Logger
+from docopt import docopt
+
+from redisbridge import HwRedisInterface
+from transport import socket_path
+
+ROUTES_KEY = 'bridge:routes'
+WORKER_KEY = 'bridge:worker:%s'
+
+def load(spec):
+    '''
+    'module:name' to the object it names
+    '''
+    module, name = spec.split(':', 1)
+    return getattr(importlib.import_module(module), name)
+
+def cpu_time():
+    t = os.times()
+    return t[0] + t[1]
+
+def run_worker(name, routes, host, interval):
+    '''
+    Main function of a worker process: bridges for routes until SIGTERM
+    '''
+    Log = Logger('BridgeWorker %s' % name)
+    stopping = Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    r = redis.Redis(host=host)
+    bridges = []
+    for channel, spec, kwargs in routes:
+        interface = load(spec)(**kwargs)
+        if hasattr(interface, 'start_thread'):
+            interface.start_thread()
+        bridges.append(HwRedisInterface(interface, channel=channel, host=host, socket_path=socket_path(channel)))
+        Log.info('serving %s with %s' % (channel, spec))
+
+    c0, t0 = cpu_time(), time.time()
+    while not stopping.isSet():
+        stopping.wait(interval)
+        c1, t1 = cpu_time(), time.time()
+        state = {'pid'     : os.getpid(),
+                 'time'    : t1,
+                 'cpu'     : c1,
+                 'cpu_load': (c1 - c0) / max(1e-6, t1 - t0),
+                 'channels': dict((b.channel, {'messages': b.msg_count, 'queue': b.queue.qsize()})
+                                  for b in bridges)}
+        c0, t0 = c1, t1
+        try:
+            r.set(WORKER_KEY % name, sjson.dumps(state))
+            r.expire(WORKER_KEY % name, int(3 * interval) + 1)
+        except Exception as E:
+            Log.error('report: %s' % E)
+
+    for bridge in bridges:
+        bridge.stop()
+    Log.info('stopped')
+
+##########################################################################################
+class WorkerProcess(object):
+    '''
+    Bookkeeping of one worker for the supervisor
+    '''
+
+    def __init__(self, name, routes):
+        self.name       = name
+        self.routes     = routes
+        self.process    = None
+        self.started    = 0
+        self.restarts   = 0
+        self.backoff    = 0
+        self.next_start = 0
+
+##########################################################################################
+class BridgeSupervisor(Thread):
+
+    interval    = 1.0     # seconds between health checks and load reports
+    min_uptime  = 5.0     # a worker that dies sooner is restarted with backoff ...
+    max_backoff = 60.0    # ... doubling up to this many seconds
+
+    def __init__(self, workers, host='127.0.0.1'):
+        Thread.__init__(self)
+        self.setName('BridgeSupervisor-Thread')
+        self.daemon   = True
+        self.host     = host
+        self.redis    = redis.Redis(host=host)
+        self.workers  = dict((name, WorkerProcess(name, routes)) for name, routes in workers.items())
+        self.stopping = Event()
+        self.Log      = Logger('BridgeSupervisor')
+        channels = [channel for w in self.workers.values() for channel, _, _ in w.routes]
+        if len(channels) != len(set(channels)):
+            raise ValueError('a channel can be routed to one worker only')
+
+    def routes(self):
+        '''
+        Routing table {channel: worker name}
+        '''
+        return dict((channel, w.name) for w in self.workers.values() for channel, _, _ in w.routes)
+
+    def spawn(self, worker):
+        worker.process = multiprocessing.Process(target=run_worker, name='bridge-%s' % worker.name,
+                                                 args=(worker.name, worker.routes, self.host, self.interval))
+        worker.process.daemon = True
+        worker.process.start()
+        worker.started = time.time()
+        self.Log.info('spawn(%s) pid %d' % (worker.name, worker.process.pid))
+
+    def check(self, worker):
+        '''
+        Restart worker when its process died
+        '''
+        if worker.process is not None and worker.process.is_alive():
+            return
+        now = time.time()
+        if worker.process is not None:
+            self.Log.error('worker %s exited with %s' % (worker.name, worker.process.exitcode))
+            worker.process = None
+            worker.restarts += 1
+            if now - worker.started < self.min_uptime:
+                worker.backoff = min(self.max_backoff, max(1.0, 2 * worker.backoff))
+            else:
+                worker.backoff = 0
+            worker.next_start = now + worker.backoff
+        if now >= worker.next_start:
+            self.spawn(worker)
+
+    def report(self):
+        '''
+        {worker: {'pid', 'alive', 'restarts', 'load': last report of the worker}}
+        '''
+        report = {}
+        for w in self.workers.values():
+            load = self.redis.get(WORKER_KEY % w.name)
+            report[w.name] = {'pid'     : w.process.pid if w.process is not None else None,
+                              'alive'   : w.process is not None and w.process.is_alive(),
+                              'restarts': w.restarts,
+                              'load'    : sjson.loads(load) if load else None}
+        return report
+
+    def stop(self, timeout=5):
+        self.stopping.set()
+        if self.is_alive():
+            self.join(timeout)
+        for w in self.workers.values():
+            if w.process is not None and w.process.is_alive():
+                w.process.terminate()
+        for w in self.workers.values():
+            if w.process is not None:
+                w.process.join(timeout)
+        self.redis.delete(ROUTES_KEY)
+
+    def run(self):
+        self.Log.debug('run()')
+        self.redis.set(ROUTES_KEY, sjson.dumps(self.routes()))
+        while not self.stopping.isSet():
+            for w in self.workers.values():
+                self.check(w)
+            self.stopping.wait(self.interval)
+        self.Log.debug('end of run()')
+
+if __name__ == '__main__':
+    opt = docopt(__doc__)
+    with open(opt['CONFIG']) as f:
+        S = BridgeSupervisor(sjson.load(f), host=opt['--redis'])
+    S.start()
+    try:
+        while True:
+            time.sleep(10)
+            for name, state in sorted(S.report().items()):
+                load = state['load'] or {}
+                print '%-12s pid %-6s alive %d restarts %d cpu %5.1f%%' % (name, state['pid'], state['alive'],
+                    state['restarts'], 100 * load.get('cpu_load', 0))
+    except KeyboardInterrupt:
+        pass
+    S.stop()
@@ -0,0 +1,123 @@
+"""tracing.py -
+
+Request tracing across Client -> HwRedisInterface -> hardware interface.
+
+Client.send() starts a Trace and sends it with the command, every stage
+the request passes appends [stage, time.time()], and the bridge returns
+the trace with the reply. The stages of a query are:
+
+    client.send       command published by the client
+    bridge.received   taken off pubsub by the bridge
+    bridge.dequeued   picked up by a worker
+    interface.start   interface.query() called
+    daq328p.write     written to the serial port (Daq328p)
+    daq328p.reply     reply matched (Daq328p)
+    insteon.start     PLM call made (InsteonCli, also insteon.end)
+    interface.end     interface.query() returned
+    bridge.reply      reply pushed to the client
+    client.received   reply popped by the client
+
+Code running a traced request can mark stages without being passed the
+trace: the bridge activates it for the worker thread and mark() adds to
+the active one. Finished traces go to a bounded TraceBuffer that keeps
+the most recent and the slowest ones.
+"""
+
+import time
+import heapq
+import random
+import itertools
+import threading
+
+from collections import deque
+
+_local = threading.local()
+
+##########################################################################################
+class Trace(object):
+
+    def __init__(self, trace_id=None, stages=None):
+        self.id     = trace_id or '%016x' % random.getrandbits(64)
+        self.stages = stages if stages is not None else []
+
+    def mark(self, stage, t=None):
+        self.stages.append([stage, t if t is not None else time.time()])
+
+    def duration(self):
+        if len(self.stages) < 2:
+            return 0.0
+        return self.stages[-1][1] - self.stages[0][1]
+
+    def breakdown(self):
+        '''
+        [[stage, seconds since the previous stage], ...]
+        '''
+        return [[stage, t - prev] for (_, prev), (stage, t) in zip(self.stages, self.stages[1:])]
+
+    def to_dict(self):
+        return {'id': self.id, 'stages': self.stages}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['id'], [list(stage) for stage in d['stages']])
+
+def activate(trace):
+    '''
+    Make trace the active trace of this thread, returns the previous one
+    '''
+    previous = getattr(_local, 'trace', None)
+    _local.trace = trace
+    return previous
+
+def current():
+    return getattr(_local, 'trace', None)
+
+def mark(stage):
+    '''
+    Mark stage on the active trace of this thread, if there is one
+    '''
+    trace = getattr(_local, 'trace', None)
+    if trace is not None:
+        trace.mark(stage)
+
+##########################################################################################
+class TraceBuffer(object):
+    '''
+    The last size traces and the keep_slowest slowest ever seen
+    '''
+
+    def __init__(self, size=1000, keep_slowest=20):
+        self.recent       = deque(maxlen=size)
+        self.slow         = []
+        self.keep_slowest = keep_slowest
+        self.seq          = itertools.count()
+        self.lock         = threading.Lock()
+
+    def __len__(self):
+        return len(self.recent)
+
+    def add(self, trace):
+        entry = (trace.duration(), next(self.seq), trace)
+        with self.lock:
+            self.recent.append(trace)
+            if len(self.slow) < self.keep_slowest:
+                heapq.heappush(self.slow, entry)
+            elif entry[0] > self.slow[0][0]:
+                heapq.heapreplace(self.slow, entry)
+
+    def slowest(self, n=None):
+        '''
+        Slowest traces first, as {'id', 'duration', 'stages', 'breakdown'}
+        '''
+        with self.lock:
+            traces = [trace for _, _, trace in sorted(self.slow, reverse=True)]
+        return [{'id'       : trace.id,
+                 'duration' : trace.duration(),
+                 'stages'   : trace.stages,
+                 'breakdown': trace.breakdown()} for trace in traces[:n]]
+
+    def snapshot(self):
+        '''
+        What MetricsReporter writes when it reports a TraceBuffer
+        '''
+        return {'time': time.time(), 'traces': len(self), 'slowest': self.slowest()}
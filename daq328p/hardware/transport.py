@@ -0,0 +1,193 @@
+"""transport.py -
+
+Bridge transports for clients on the same host as the bridge, they skip redis.
+
+    local    the bridge runs in the client's process: messages are handed
+             to HwRedisInterface.accept() as dicts and run in the calling
+             thread, replies come back through a callback, nothing is
+             encoded
+    unix     the bridge runs in another process on this host: messages go
+             over a unix domain socket, as frames of a 4 byte length and
+             the message in a codec of codec.py
+
+Both keep the Client API (see LocalClient and SocketClient in
+redisbridge.py), a message carries a 'deliver' callable the bridge hands
+the reply dict {'id', 'out', 'trace'} to instead of pushing it to redis.
+Every HwRedisInterface registers itself here for local clients; it serves
+unix clients when it is given a socket_path.
+
+    B = HwRedisInterface(Daq328p(), channel='test', socket_path=socket_path('test'))
+    C = connect('test', kind='unix')
+"""
+
+import os
+import struct
+import socket
+import threading
+import simplejson as sjson
+
+from logbook import Logger
+
+from codec import CODECS
+
+SOCKET_DIR = '/tmp'
+HEADER     = struct.Struct('!I')
+MAX_FRAME  = 16 * 1024 * 1024
+
+_bridges = {}
+_lock    = threading.Lock()
+
+def socket_path(channel):
+    '''
+    Default unix socket of the bridge of channel
+    '''
+    return os.path.join(SOCKET_DIR, 'daq328p-%s.sock' % channel)
+
+def register(channel, bridge):
+    with _lock:
+        _bridges[channel] = bridge
+
+def unregister(channel, bridge):
+    with _lock:
+        if _bridges.get(channel) is bridge:
+            del _bridges[channel]
+
+def local_bridge(channel):
+    '''
+    The bridge of channel running in this process, or None
+    '''
+    return _bridges.get(channel)
+
+def resolve(transport, channel):
+    '''
+    'redis', 'local', 'unix', 'unix:PATH' or 'auto' to (kind, socket path).
+    auto is local when the bridge runs in this process, unix when its
+    socket exists and redis otherwise.
+    '''
+    kind, _, path = (transport or 'redis').partition(':')
+    if kind == 'auto':
+        if local_bridge(channel) is not None:
+            return 'local', None
+        if os.path.exists(socket_path(channel)):
+            kind = 'unix'
+        else:
+            return 'redis', None
+    if kind == 'unix':
+        return kind, path or socket_path(channel)
+    if kind not in ('redis', 'local'):
+        raise ValueError('unknown transport %s' % transport)
+    return kind, None
+
+def send_frame(sock, data):
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+def recv_exactly(sock, n):
+    chunks = []
+    while n:
+        chunk = sock.recv(n)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        n -= len(chunk)
+    return ''.join(chunks)
+
+def recv_frame(sock):
+    '''
+    The next frame, None when the other end closed the socket
+    '''
+    header = recv_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+    size, = HEADER.unpack(header)
+    if size > MAX_FRAME:
+        raise ValueError('frame of %d bytes' % size)
+    return recv_exactly(sock, size)
+
+##########################################################################################
+class UnixServer(threading.Thread):
+    '''
+    Serves bridge on the unix socket path, one thread per connection.
+    The first frame to a new connection is the json list of codecs the
+    bridge decodes, the preferred first. A stale socket file left at
+    path is replaced, one another bridge still answers on is an IOError;
+    stop() removes the file only if it is still this server's.
+    '''
+
+    def __init__(self, bridge, path):
+        threading.Thread.__init__(self)
+        self.setName('UnixServer-Thread')
+        self.daemon   = True
+        self.bridge   = bridge
+        self.path     = path
+        self.stopping = threading.Event()
+        self.Log      = Logger('UnixServer')
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except socket.error:
+                os.unlink(path)
+            else:
+                raise IOError('%s is served by another bridge' % path)
+            finally:
+                probe.close()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(16)
+        self.inode = os.stat(path).st_ino
+
+    def stop(self):
+        self.stopping.set()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+        try:
+            if os.stat(self.path).st_ino == self.inode:
+                os.unlink(self.path)
+        except OSError:
+            pass
+
+    def run(self):
+        self.Log.debug('run(%s)' % self.path)
+        while not self.stopping.isSet():
+            try:
+                conn, _ = self.sock.accept()
+            except socket.error as E:
+                if not self.stopping.isSet():
+                    self.Log.error('accept(): %s' % E)
+                break
+            worker = threading.Thread(target=self.serve, args=(conn,), name='UnixServer-Connection')
+            worker.daemon = True
+            worker.start()
+        self.Log.debug('end of run()')
+
+    def serve(self, conn):
+        lock = threading.Lock()
+
+        def deliver(codec):
+            def write(reply):
+                data = codec.encode(reply)
+                with lock:
+                    try:
+                        send_frame(conn, data)
+                    except socket.error as E:
+                        self.Log.error('deliver(): %s' % E)
+            return write
+
+        try:
+            send_frame(conn, sjson.dumps(sorted(CODECS, key=lambda name: name == 'json')))
+            while not self.stopping.isSet():
+                data = recv_frame(conn)
+                if data is None:
+                    break
+                msg = self.bridge.decode({'data': data})
+                if msg is None:
+                    continue
+                msg['deliver'] = deliver(CODECS.get(msg.get('codec'), CODECS['json']))
+                self.bridge.accept(msg)
+        except Exception as E:
+            self.Log.error('serve(): %s' % E)
+        finally:
+            conn.close()